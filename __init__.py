@@ -1 +1,2 @@
 from fsmcontainers.fsmcontainers.fsmcontainers import *
+from fsmcontainers.fsmcontainers.rules import Rule, RuleSet, RuleStats
@@ -0,0 +1,160 @@
+""" Asyncio integration: run lookups against a container in an executor, so
+that slow lookups do not block the event loop. """
+
+import asyncio
+import concurrent.futures
+import functools
+import weakref
+
+DEFAULT_MAX_PENDING = 64
+
+
+def _lookup(container, kind, key):
+    if kind == "getitem":
+        return container[key]
+    if kind == "query":
+        return container.query(key)
+    if kind == "batch":
+        return [container[k] for k in key]
+    raise ValueError(kind)
+
+
+# Process pools are given their container once, when each worker starts,
+# rather than having it pickled along with every lookup.
+_workerContainer = None
+
+def _installContainer(container):
+    global _workerContainer
+    _workerContainer = container
+
+def _workerLookup(kind, key):
+    return _lookup(_workerContainer, kind, key)
+
+
+def makeExecutor(container, executor="thread", workers=None):
+    """ Return ``(executor, inProcess, owned)`` for :meth:`with_executor`.
+    *inProcess* says whether lookups run in this process, and so need to be
+    passed the container; *owned* says whether the executor was created
+    here, and so is the container's to shut down. """
+    if executor == "thread":
+        return concurrent.futures.ThreadPoolExecutor(workers), True, True
+    if executor == "process":
+        return concurrent.futures.ProcessPoolExecutor(
+                workers,
+                initializer=_installContainer,
+                initargs=(container,)), False, True
+    if isinstance(executor, concurrent.futures.Executor):
+        return executor, True, False
+    raise ValueError("executor must be 'thread', 'process' or an Executor")
+
+
+class AsyncDispatcher(object):
+    """ Dispatches lookups against one container from one event loop.
+
+    Concurrent requests for the same key share a single executor job, and at
+    most *maxPending* jobs are outstanding at once; further requests wait
+    for a slot, which pushes back on callers instead of queueing unbounded
+    work in the executor. """
+
+    def __init__(self, container, executor, inProcess, maxPending):
+        self.container = container
+        self.executor = executor
+        self.inProcess = inProcess
+        self.maxPending = maxPending
+        self.semaphore = asyncio.Semaphore(maxPending)
+        self.inflight = {}
+
+    def _job(self, kind, key):
+        if self.inProcess:
+            return functools.partial(_lookup, self.container, kind, key)
+        return functools.partial(_workerLookup, kind, key)
+
+    async def _run(self, kind, key):
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor,
+                                              self._job(kind, key))
+
+    async def submit(self, kind, key):
+        token = key
+        if kind == "query" and not isinstance(key, str):
+            token = frozenset(key)
+        try:
+            hash(token)
+        except TypeError:
+            return await self._run(kind, key)
+        token = (kind, token)
+        task = self.inflight.get(token)
+        if task is None:
+            task = asyncio.ensure_future(self._run(kind, key))
+            self.inflight[token] = task
+            task.add_done_callback(
+                    lambda _: self.inflight.pop(token, None))
+        # Shield the shared job, so that one cancelled caller does not
+        # cancel it for every other caller waiting on the same key.
+        return await asyncio.shield(task)
+
+    async def batch(self, keys):
+        return await self._run("batch", list(keys))
+
+    async def stream(self, keys):
+        """ Yield ``(key, value)`` for each key of the (synchronous or
+        asynchronous) iterable *keys*, in order, with lookups running ahead
+        of the consumer by at most the dispatcher's pending limit. If a
+        lookup fails or the consumer stops early, the lookups still queued
+        are cancelled and collected before the stream closes. """
+        # The queue itself is unbounded, so that the producer never waits to
+        # put its end marker, even when nobody is left to take it; the
+        # semaphore bounds how far lookups run ahead.
+        pending = asyncio.Queue()
+        slots = asyncio.Semaphore(self.maxPending)
+
+        async def enqueue(key):
+            await slots.acquire()
+            pending.put_nowait((key, asyncio.ensure_future(
+                    self.submit("getitem", key))))
+
+        async def produce():
+            try:
+                if hasattr(keys, "__aiter__"):
+                    async for key in keys:
+                        await enqueue(key)
+                else:
+                    for key in keys:
+                        await enqueue(key)
+            finally:
+                pending.put_nowait(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                entry = await pending.get()
+                if entry is None:
+                    break
+                slots.release()
+                key, future = entry
+                yield key, await future
+            await producer
+        finally:
+            producer.cancel()
+            queued = []
+            while not pending.empty():
+                entry = pending.get_nowait()
+                if entry is not None:
+                    entry[1].cancel()
+                    queued.append(entry[1])
+            await asyncio.gather(producer, *queued, return_exceptions=True)
+
+
+def dispatcher(container):
+    """ Return the dispatcher for *container* on the running event loop,
+    creating it the first time. """
+    loop = asyncio.get_running_loop()
+    perLoop = container.__dict__.setdefault("_asyncDispatchers",
+                                            weakref.WeakKeyDictionary())
+    if loop not in perLoop:
+        perLoop[loop] = AsyncDispatcher(container,
+                                        container.asyncExecutor,
+                                        container.asyncInProcess,
+                                        container.asyncMaxPending)
+    return perLoop[loop]
@@ -0,0 +1,710 @@
+""" A pure NumPy engine for unweighted machines.
+
+Machines are held as parallel arrays of arcs (source, input label, output
+label, destination), sorted by source state, and an array marking the final
+states. Labels are indexes into a tuple of the strings they stand for, with
+0 for epsilon. Epsilon closure, reachability, determinization and
+minimization work on whole arrays of states at a time.
+
+The engine needs nothing but NumPy, so a service can load machines compiled
+elsewhere and saved with :meth:`ArrayWrapper.write`, and serve lookups from
+them, without importing Pynini. Weights are not supported, and are dropped
+when a weighted machine is converted. """
+
+import operator
+import threading
+import numpy as np
+from .wrappers import EngineWrapper
+from .graph import StateGraph, functionalityWitness, tokenize, detokenize
+from .parallel import balancedReduce
+from .settings import get_optimization_level
+
+
+def _reach(mask, src, dst):
+    """ Return a copy of the boolean state *mask* extended along the arcs
+    ``src -> dst`` until nothing more can be reached. """
+    mask = mask.copy()
+    frontier = mask.copy()
+    while frontier.any():
+        reached = np.zeros_like(mask)
+        reached[dst[frontier[src]]] = True
+        frontier = reached & ~mask
+        mask |= frontier
+    return mask
+
+
+def _mergeLabels(*machines):
+    """ Return a label tuple covering the labels of all *machines*, and a
+    dict from each label to its index. """
+    labels = [""]
+    index = {"": 0}
+    for machine in machines:
+        for label in machine.labels:
+            if label not in index:
+                index[label] = len(labels)
+                labels.append(label)
+    return labels, index
+
+
+def _asArray(wrapper):
+    if isinstance(wrapper, ArrayWrapper):
+        return wrapper
+    return ArrayWrapper.fromWrapper(wrapper)
+
+
+class ArrayWrapper(EngineWrapper):
+    """ Wraps an unweighted machine held in NumPy arrays. Like Pynini
+    machines, these are never modified once wrapped; derived machines and
+    graphs are computed once, under a per-wrapper lock, and cached. """
+
+    engine = "array"
+
+    def __init__(self, labels, start, src, ilabel, olabel, dst, final):
+        order = np.argsort(np.asarray(src, dtype=np.int64), kind="stable")
+        self.labels = tuple(labels)
+        self.start = None if start is None else int(start)
+        self.src = np.asarray(src, dtype=np.int64)[order]
+        self.ilabel = np.asarray(ilabel, dtype=np.int64)[order]
+        self.olabel = np.asarray(olabel, dtype=np.int64)[order]
+        self.dst = np.asarray(dst, dtype=np.int64)[order]
+        self.final = np.asarray(final, dtype=bool)
+        self.offsets = np.searchsorted(self.src,
+                                       np.arange(len(self.final) + 1))
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def _cached(self, key, compute):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in
+                ("labels", "start", "src", "ilabel", "olabel", "dst",
+                 "final")}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def fsm(self):
+        raise TypeError("An array machine cannot be combined with a Pynini "
+                        "machine; convert one of them with with_engine()")
+
+    @classmethod
+    def empty(cls, labels=("",)):
+        return cls(labels, None, [], [], [], [], [])
+
+    @classmethod
+    def fromArcs(cls, labels, start, arcs, final):
+        """ Build a machine from ``(src, ilabel, olabel, dst)`` tuples. """
+        arcs = np.array(list(arcs), dtype=np.int64).reshape(-1, 4)
+        return cls(labels, start, arcs[:, 0], arcs[:, 1], arcs[:, 2],
+                   arcs[:, 3], final)
+
+    @classmethod
+    def fromPairs(cls, pairs):
+        """ Build a trie over the tokens of (input, output) string pairs,
+        padding the shorter side of each pair with epsilons at the end. """
+        labels = [""]
+        index = {"": 0}
+        def code(token):
+            if token not in index:
+                index[token] = len(labels)
+                labels.append(token)
+            return index[token]
+        children = [{}]
+        final = [False]
+        arcs = []
+        for k, v in pairs:
+            inputs, outputs = tokenize(k), tokenize(v)
+            length = max(len(inputs), len(outputs))
+            inputs += [""] * (length - len(inputs))
+            outputs += [""] * (length - len(outputs))
+            state = 0
+            for i, o in zip(inputs, outputs):
+                key = (code(i), code(o))
+                nextstate = children[state].get(key)
+                if nextstate is None:
+                    nextstate = len(children)
+                    children.append({})
+                    final.append(False)
+                    children[state][key] = nextstate
+                    arcs.append((state, key[0], key[1], nextstate))
+                state = nextstate
+            final[state] = True
+        return cls.fromArcs(labels, 0, arcs, final)
+
+    @classmethod
+    def fromItems(cls, items):
+        return cls.fromPairs((item, item) for item in items)
+
+    @classmethod
+    def fromItem(cls, item):
+        return cls.fromPairs([(item, item)])
+
+    @classmethod
+    def fromGraph(cls, graph):
+        """ Build a machine from a :class:`StateGraph`, dropping weights. """
+        labels = [""]
+        index = {"": 0}
+        arcs = []
+        for state, stateArcs in enumerate(graph.arcs):
+            for ilabel, olabel, _, nextstate in stateArcs:
+                for label in (ilabel, olabel):
+                    if label not in index:
+                        index[label] = len(labels)
+                        labels.append(label)
+                arcs.append((state, index[ilabel], index[olabel], nextstate))
+        final = [state in graph.finals for state in range(graph.numStates)]
+        return cls.fromArcs(labels, graph.start, arcs, final)
+
+    @classmethod
+    def fromWrapper(cls, wrapper):
+        """ Convert a machine wrapped by any engine. """
+        if isinstance(wrapper, cls):
+            return wrapper
+        if wrapper.engine == "set":
+            return cls.fromPairs(wrapper.pairs)
+        return cls.fromGraph(wrapper.graph())
+
+    @classmethod
+    def fromFilename(cls, filename):
+        """ Load a machine saved with :meth:`write`. """
+        with np.load(filename) as data:
+            start = int(data["start"])
+            return cls(data["labels"].tolist(),
+                       None if start < 0 else start,
+                       data["src"], data["ilabel"], data["olabel"],
+                       data["dst"], data["final"])
+
+    def write(self, filename):
+        """ Save this machine to *filename* in NumPy's ``.npz`` format. """
+        with open(filename, "wb") as f:
+            np.savez_compressed(
+                    f, labels=np.array(self.labels, dtype=str),
+                    start=np.int64(-1 if self.start is None else self.start),
+                    src=self.src, ilabel=self.ilabel, olabel=self.olabel,
+                    dst=self.dst, final=self.final)
+
+    def _relabeled(self, index):
+        """ Return this machine's input and output label arrays in terms of
+        the label *index* of a merged label table. """
+        mapping = np.array([index[label] for label in self.labels],
+                           dtype=np.int64)
+        return mapping[self.ilabel], mapping[self.olabel]
+
+    def _arcsFrom(self, state):
+        begin, end = self.offsets[state], self.offsets[state + 1]
+        return (self.ilabel[begin:end], self.olabel[begin:end],
+                self.dst[begin:end])
+
+    @classmethod
+    def _fromResult(cls, machine):
+        """ Apply the current optimization level to a freshly built machine.
+        "cheap" trims it; epsilon arcs are left for determinization. """
+        level = get_optimization_level()
+        if level == "cheap":
+            return machine.trimmed()
+        if level == "full":
+            return machine.optimized()
+        return machine
+
+    def numStates(self):
+        return len(self.final)
+
+    def numArcs(self):
+        return len(self.src)
+
+    def _startMask(self):
+        mask = np.zeros(self.numStates(), dtype=bool)
+        if self.start is not None:
+            mask[self.start] = True
+        return mask
+
+    def _closure(self, mask, side):
+        labels = self.ilabel if side == "top" else self.olabel
+        epsilon = labels == 0
+        return _reach(mask, self.src[epsilon], self.dst[epsilon])
+
+    def _transitions(self, side):
+        """ Return a dict from each (state, label) pair to the states that
+        arcs leaving that state with that label on *side* lead to. It is
+        built once per side, so that a lookup only visits the arcs of the
+        states it reaches. """
+        def build():
+            labels = self.ilabel if side == "top" else self.olabel
+            table = {}
+            for arc in zip(self.src.tolist(), labels.tolist(),
+                           self.dst.tolist()):
+                table.setdefault(arc[:2], []).append(arc[2])
+            return table
+        return self._cached(("transitions", side), build)
+
+    def accepts(self, item, side="top"):
+        if self.start is None:
+            return False
+        index = self._cached("index", lambda: {
+                label: i for i, label in enumerate(self.labels)})
+        table = self._transitions(side)
+        def closure(states):
+            stack = list(states)
+            while stack:
+                for nextstate in table.get((stack.pop(), 0), ()):
+                    if nextstate not in states:
+                        states.add(nextstate)
+                        stack.append(nextstate)
+            return states
+        states = closure({self.start})
+        for token in tokenize(item):
+            label = index.get(token)
+            if label is None:
+                return False
+            states = closure({nextstate for state in states
+                              for nextstate in table.get((state, label), ())})
+            if not states:
+                return False
+        return any(self.final[state] for state in states)
+
+    def trimmed(self):
+        """ Return a copy keeping only the states on some successful path.
+        """
+        if self.start is None:
+            return self
+        keep = (_reach(self._startMask(), self.src, self.dst) &
+                _reach(self.final, self.dst, self.src))
+        if not keep[self.start]:
+            return type(self).empty(self.labels)
+        renumber = np.cumsum(keep) - 1
+        arcs = keep[self.src] & keep[self.dst]
+        return type(self)(self.labels, renumber[self.start],
+                          renumber[self.src[arcs]], self.ilabel[arcs],
+                          self.olabel[arcs], renumber[self.dst[arcs]],
+                          self.final[keep])
+
+    def determinized(self):
+        """ Return an equivalent machine with no epsilon:epsilon arcs and at
+        most one arc per (input, output) label pair leaving each state, by
+        subset construction over label pairs. Each subset is a boolean array
+        of states, and its epsilon closure and successors are computed over
+        all of its states at once. """
+        cls = type(self)
+        if self.start is None:
+            return self
+        width = len(self.labels)
+        codes = self.ilabel * width + self.olabel
+        epsilon = codes == 0
+        epsSrc, epsDst = self.src[epsilon], self.dst[epsilon]
+        src, codes, dst = (self.src[~epsilon], codes[~epsilon],
+                           self.dst[~epsilon])
+        first = _reach(self._startMask(), epsSrc, epsDst)
+        subsets = [first]
+        ids = {first.tobytes(): 0}
+        arcs = []
+        i = 0
+        while i < len(subsets):
+            leaving = subsets[i][src]
+            groupCodes, groupDst = codes[leaving], dst[leaving]
+            order = np.argsort(groupCodes, kind="stable")
+            groupCodes, groupDst = groupCodes[order], groupDst[order]
+            uniqueCodes, starts = np.unique(groupCodes, return_index=True)
+            for code, targets in zip(uniqueCodes,
+                                     np.split(groupDst, starts[1:])):
+                subset = np.zeros(self.numStates(), dtype=bool)
+                subset[targets] = True
+                subset = _reach(subset, epsSrc, epsDst)
+                key = subset.tobytes()
+                if key not in ids:
+                    ids[key] = len(subsets)
+                    subsets.append(subset)
+                arcs.append((i, code // width, code % width, ids[key]))
+            i += 1
+        final = [bool((subset & self.final).any()) for subset in subsets]
+        return cls.fromArcs(self.labels, 0, arcs, final)
+
+    def minimized(self):
+        """ Return the minimal equivalent of this machine, which must be
+        deterministic and trimmed. Moore's partition refinement: each round
+        gives every state a row holding its class and the (label pair, class
+        of destination) of each of its arcs, in label order, and splits
+        classes by their distinct rows, until no class splits. """
+        cls = type(self)
+        numStates = self.numStates()
+        if self.start is None or numStates == 0:
+            return self
+        width = len(self.labels)
+        codes = self.ilabel * width + self.olabel
+        order = np.lexsort((codes, self.src))
+        src, codes, dst = self.src[order], codes[order], self.dst[order]
+        degree = np.bincount(src, minlength=numStates)
+        position = np.arange(len(src)) - np.repeat(
+                np.cumsum(degree) - degree, degree)
+        columns = 1 + 2 * (int(degree.max()) if len(src) else 0)
+        classes = self.final.astype(np.int64)
+        numClasses = len(np.unique(classes))
+        while True:
+            rows = np.full((numStates, columns), -1, dtype=np.int64)
+            rows[:, 0] = classes
+            rows[src, 1 + 2 * position] = codes
+            rows[src, 2 + 2 * position] = classes[dst]
+            _, classes = np.unique(rows, axis=0, return_inverse=True)
+            classes = classes.ravel()
+            count = int(classes.max()) + 1
+            if count == numClasses:
+                break
+            numClasses = count
+        arcs = np.unique(np.stack([classes[src], codes, classes[dst]],
+                                  axis=1), axis=0)
+        final = np.zeros(numClasses, dtype=bool)
+        final[classes[self.final]] = True
+        return cls(self.labels, classes[self.start], arcs[:, 0],
+                   arcs[:, 1] // width, arcs[:, 1] % width, arcs[:, 2],
+                   final)
+
+    def optimize(self, level="full"):
+        """ Return a copy optimized to *level* (see
+        :func:`set_optimization_level`). """
+        if level == "full":
+            return self.optimized()
+        if level == "cheap":
+            return self.trimmed()
+        return self
+
+    def optimized(self):
+        """ Return the minimal deterministic equivalent of this machine,
+        computing it only once. """
+        def compute():
+            machine = self.trimmed().determinized().trimmed().minimized()
+            machine._cache["optimized"] = machine
+            return machine
+        return self._cached("optimized", compute)
+
+    def prepareForComposition(self, lookahead=False):
+        """ Arcs are always stored sorted by state, so there is nothing to
+        prepare. """
+        return self
+
+    def graph(self):
+        """ Return a :class:`StateGraph` view of this machine, building it
+        only once. """
+        def compute():
+            arcs = [[] for _ in range(self.numStates())]
+            for s, i, o, d in zip(self.src.tolist(), self.ilabel.tolist(),
+                                  self.olabel.tolist(), self.dst.tolist()):
+                arcs[s].append((self.labels[i], self.labels[o], 0.0, d))
+            finals = {state: 0.0 for state in np.flatnonzero(self.final)
+                      .tolist()}
+            return StateGraph(self.start, arcs, finals)
+        return self._cached("graph", compute)
+
+    def isCyclic(self):
+        """ Return True if this machine has infinitely many paths: if its
+        optimized form has a cycle, found by repeatedly removing all states
+        with no incoming arcs. """
+        machine = self.optimized()
+        src, dst = machine.src, machine.dst
+        indegree = np.bincount(dst, minlength=machine.numStates())
+        alive = np.ones(machine.numStates(), dtype=bool)
+        while True:
+            sources = alive & (indegree == 0)
+            if not sources.any():
+                return bool(alive.any())
+            alive &= ~sources
+            np.subtract.at(indegree, dst[sources[src]], 1)
+
+    def hasPaths(self):
+        return self.trimmed().start is not None
+
+    def pathIterator(self, limit=None, side=None):
+        machine = self.optimized()
+        if machine.start is None or limit == 0:
+            return
+        if limit is None and machine.isCyclic():
+            raise ValueError("Can't iterate over this mapping. It is cyclic "
+                             "and may accept infinitely many keys.")
+        labels = machine.labels
+        seen = set()
+        queue = [(machine.start, (), ())]
+        # Breadth-first, so that a limit on a cyclic machine is still met.
+        # Different epsilon alignments can spell the same pair, so pairs are
+        # deduplicated.
+        while queue:
+            nextQueue = []
+            for state, inputs, outputs in queue:
+                if machine.final[state]:
+                    pair = (detokenize(labels[i] for i in inputs),
+                            detokenize(labels[o] for o in outputs))
+                    if pair not in seen:
+                        seen.add(pair)
+                        if side == "top":
+                            yield pair[0]
+                        elif side == "bottom":
+                            yield pair[1]
+                        else:
+                            yield pair
+                        if limit is not None and len(seen) >= limit:
+                            return
+                for i, o, d in zip(*machine._arcsFrom(state)):
+                    nextQueue.append((int(d), inputs + (int(i),),
+                                      outputs + (int(o),)))
+            queue = nextQueue
+
+    def weightedPathIterator(self, limit=None, side=None):
+        return ((path, 0.0) for path in self.pathIterator(limit, side))
+
+    def numPathsCompare(self, n, op=operator.eq):
+        return op(len(list(self.pathIterator(limit=n + 1))), n)
+
+    def __eq__(self, other):
+        other = _asArray(other)
+        return not (self.subtract(other).hasPaths() or
+                    other.subtract(self).hasPaths())
+
+    def _disjointUnion(self, other, index):
+        """ Return the arcs of this machine and *other* relabeled by *index*,
+        with *other*'s states numbered after this machine's. """
+        ai, ao = self._relabeled(index)
+        bi, bo = other._relabeled(index)
+        shift = self.numStates()
+        return (np.concatenate([self.src, other.src + shift]),
+                np.concatenate([ai, bi]), np.concatenate([ao, bo]),
+                np.concatenate([self.dst, other.dst + shift]),
+                np.concatenate([self.final, other.final]))
+
+    def concatenate(self, other):
+        cls = type(self)
+        other = _asArray(other)
+        labels, index = _mergeLabels(self, other)
+        if self.start is None or other.start is None:
+            return cls.empty(labels)
+        src, ilabel, olabel, dst, final = self._disjointUnion(other, index)
+        finals = np.flatnonzero(self.final)
+        zeros = np.zeros(len(finals), dtype=np.int64)
+        final[:self.numStates()] = False
+        return cls._fromResult(cls(
+                labels, self.start,
+                np.concatenate([src, finals]),
+                np.concatenate([ilabel, zeros]),
+                np.concatenate([olabel, zeros]),
+                np.concatenate([dst, zeros + other.start + self.numStates()]),
+                final))
+
+    def union(self, other):
+        cls = type(self)
+        other = _asArray(other)
+        labels, index = _mergeLabels(self, other)
+        src, ilabel, olabel, dst, final = self._disjointUnion(other, index)
+        start = len(final)
+        starts = []
+        if self.start is not None:
+            starts.append(self.start)
+        if other.start is not None:
+            starts.append(other.start + self.numStates())
+        zeros = np.zeros(len(starts), dtype=np.int64)
+        return cls._fromResult(cls(
+                labels, start,
+                np.concatenate([src, zeros + start]),
+                np.concatenate([ilabel, zeros]),
+                np.concatenate([olabel, zeros]),
+                np.concatenate([dst, np.array(starts, dtype=np.int64)]),
+                np.append(final, False)))
+
+    def priorityUnion(self, *others):
+        """ Return a machine mapping each key of this machine as this
+        machine does, and any other key as the first of *others* that has it
+        does, by subtracting the keys already claimed from each domain. """
+        pieces = [self]
+        claimed = self.project("top")
+        for other in others:
+            other = _asArray(other)
+            domain = other.project("top")
+            pieces.append(domain.subtract(claimed).compose(other))
+            claimed = claimed.union(domain)
+        return balancedReduce(type(self).union, pieces)
+
+    def _product(self, other, subtract):
+        """ Intersect (or, with *subtract*, take the difference of) the label
+        pair languages of two machines, by exploring pairs of states of
+        their deterministic forms. For a difference, the second state of a
+        pair is -1 once *other* has no matching arc. """
+        cls = type(self)
+        labels, index = _mergeLabels(self, other)
+        width = len(labels)
+        a, b = self.optimized(), _asArray(other).optimized()
+        if a.start is None or (b.start is None and not subtract):
+            return cls.empty(labels)
+        tables = []
+        for machine in (a, b):
+            ilabel, olabel = machine._relabeled(index)
+            tables.append((ilabel * width + olabel, machine.dst,
+                           machine.offsets))
+        def arcsFrom(table, state):
+            codes, dst, offsets = table
+            if state < 0:
+                return codes[:0], dst[:0]
+            begin, end = offsets[state], offsets[state + 1]
+            order = np.argsort(codes[begin:end])
+            return codes[begin:end][order], dst[begin:end][order]
+        origin = (a.start, -1 if b.start is None else b.start)
+        ids = {origin: 0}
+        pairs = [origin]
+        arcs = []
+        final = []
+        i = 0
+        while i < len(pairs):
+            p, q = pairs[i]
+            aCodes, aDst = arcsFrom(tables[0], p)
+            bCodes, bDst = arcsFrom(tables[1], q)
+            if subtract:
+                final.append(bool(a.final[p]) and (q < 0 or not b.final[q]))
+                if len(bCodes):
+                    found = np.minimum(np.searchsorted(bCodes, aCodes),
+                                       len(bCodes) - 1)
+                    bTargets = np.where(bCodes[found] == aCodes,
+                                        bDst[found], -1)
+                else:
+                    bTargets = np.full(len(aCodes), -1)
+                targets = zip(aCodes.tolist(), aDst.tolist(),
+                              bTargets.tolist())
+            else:
+                final.append(bool(a.final[p] and b.final[q]))
+                common, x, y = np.intersect1d(aCodes, bCodes,
+                                              assume_unique=True,
+                                              return_indices=True)
+                targets = zip(common.tolist(), aDst[x].tolist(),
+                              bDst[y].tolist())
+            for code, p2, q2 in targets:
+                if (p2, q2) not in ids:
+                    ids[(p2, q2)] = len(pairs)
+                    pairs.append((p2, q2))
+                arcs.append((i, code // width, code % width, ids[(p2, q2)]))
+            i += 1
+        return cls._fromResult(cls.fromArcs(labels, 0, arcs, final))
+
+    def intersect(self, other):
+        return self._product(other, subtract=False)
+
+    def subtract(self, other):
+        return self._product(other, subtract=True)
+
+    def compose(self, other):
+        """ Compose by exploring pairs of states. Unweighted composition
+        needs no epsilon filter: redundant epsilon paths only duplicate
+        paths, which changes nothing without weights. """
+        cls = type(self)
+        other = _asArray(other)
+        labels, index = _mergeLabels(self, other)
+        if self.start is None or other.start is None:
+            return cls.empty(labels)
+        aIn, aOut = self._relabeled(index)
+        bIn, bOut = other._relabeled(index)
+        ids = {(self.start, other.start): 0}
+        pairs = [(self.start, other.start)]
+        arcs = []
+        final = []
+        i = 0
+        while i < len(pairs):
+            p, q = pairs[i]
+            final.append(bool(self.final[p] and other.final[q]))
+            aBegin, aEnd = self.offsets[p], self.offsets[p + 1]
+            bBegin, bEnd = other.offsets[q], other.offsets[q + 1]
+            ai, ao, ad = (aIn[aBegin:aEnd], aOut[aBegin:aEnd],
+                          self.dst[aBegin:aEnd])
+            bi, bo, bd = (bIn[bBegin:bEnd], bOut[bBegin:bEnd],
+                          other.dst[bBegin:bEnd])
+            x, y = np.nonzero((ao[:, None] == bi[None, :]) &
+                              (ao[:, None] != 0))
+            moves = [(ai[x], bo[y], ad[x], bd[y])]
+            aAlone = ao == 0
+            moves.append((ai[aAlone], ao[aAlone], ad[aAlone],
+                          np.full(aAlone.sum(), q)))
+            bAlone = bi == 0
+            moves.append((bi[bAlone], bo[bAlone],
+                          np.full(bAlone.sum(), p), bd[bAlone]))
+            for moveIn, moveOut, moveP, moveQ in moves:
+                for il, ol, p2, q2 in zip(moveIn.tolist(), moveOut.tolist(),
+                                          moveP.tolist(), moveQ.tolist()):
+                    if (p2, q2) not in ids:
+                        ids[(p2, q2)] = len(pairs)
+                        pairs.append((p2, q2))
+                    arcs.append((i, il, ol, ids[(p2, q2)]))
+            i += 1
+        return cls._fromResult(cls.fromArcs(labels, 0, arcs, final))
+
+    def lenientlyCompose(self, other):
+        raise NotImplementedError("Lenient composition needs Pynini")
+
+    def project(self, side="top"):
+        if side not in {"top", "bottom"}:
+            raise ValueError
+        labels = self.ilabel if side == "top" else self.olabel
+        return type(self)(self.labels, self.start, self.src, labels, labels,
+                          self.dst, self.final)
+
+    def invert(self):
+        return type(self)(self.labels, self.start, self.src, self.olabel,
+                          self.ilabel, self.dst, self.final)
+
+    def cross(self, other):
+        cls = type(self)
+        other = _asArray(other)
+        left = cls(self.labels, self.start, self.src, self.ilabel,
+                   np.zeros_like(self.ilabel), self.dst, self.final)
+        right = cls(other.labels, other.start, other.src,
+                    np.zeros_like(other.olabel), other.olabel, other.dst,
+                    other.final)
+        return left.concatenate(right)
+
+    def _loopBack(self, start, final):
+        """ Add epsilon arcs from every final state to *start*. """
+        cls = type(self)
+        finals = np.flatnonzero(final)
+        zeros = np.zeros(len(finals), dtype=np.int64)
+        src = np.concatenate([self.src, finals])
+        return cls._fromResult(cls(
+                self.labels, start, src,
+                np.concatenate([self.ilabel, zeros]),
+                np.concatenate([self.olabel, zeros]),
+                np.concatenate([self.dst, zeros + start]), final))
+
+    def star(self):
+        cls = type(self)
+        start = self.numStates()
+        final = np.append(self.final, True)
+        if self.start is None:
+            return cls(self.labels, start, self.src, self.ilabel,
+                       self.olabel, self.dst, final)
+        machine = cls(self.labels, start, np.append(self.src, start),
+                      np.append(self.ilabel, 0), np.append(self.olabel, 0),
+                      np.append(self.dst, self.start), final)
+        return machine._loopBack(start, final)
+
+    def plus(self):
+        if self.start is None:
+            return self
+        return self._loopBack(self.start, self.final)
+
+    def sigma(self):
+        used = np.unique(np.concatenate([self.ilabel, self.olabel]))
+        symbols = (detokenize([self.labels[label]])
+                   for label in used.tolist() if label)
+        return type(self).fromPairs((symbol, symbol) for symbol in symbols)
+
+    def makeRewrite(self, *args, **kwargs):
+        raise NotImplementedError("Rewrite rules need Pynini")
+
+    def ambiguityWitness(self):
+        return self._cached("ambiguity",
+                            lambda: functionalityWitness(self.graph()))
+
+    def isFunctional(self):
+        return self.ambiguityWitness() is None
+
+    def findAmbiguity(self, strictness=None):
+        witness = self.ambiguityWitness()
+        return witness and witness[1:]
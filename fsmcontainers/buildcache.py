@@ -0,0 +1,199 @@
+""" An on-disk cache of compiled containers, so that scripts which build a
+large grammar at startup only compile it when its inputs or code change. """
+
+import functools
+import hashlib
+import importlib
+import inspect
+import marshal
+import os
+import pickle
+import re
+import tempfile
+
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+# Bump to invalidate every cache entry when the pickled format changes.
+_FORMAT = b"2"
+
+# The libraries whose machines are pickled in cache entries. Their versions
+# are part of every fingerprint, since an upgrade can change the stored
+# format or the machines a build produces.
+_ENGINES = ("pynini", "numpy")
+
+
+def default_cache_dir():
+    """ The directory named by the ``FSMCONTAINERS_CACHE`` environment
+    variable, or ``~/.cache/fsmcontainers``. """
+    return (os.environ.get("FSMCONTAINERS_CACHE") or
+            os.path.join(os.path.expanduser("~"), ".cache", "fsmcontainers"))
+
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj).encode("utf8")
+    except (OSError, TypeError):
+        code = getattr(obj, "__code__", None)
+        return marshal.dumps(code) if code is not None else repr(obj).encode()
+
+
+@functools.lru_cache(maxsize=None)
+def _engineVersions():
+    versions = []
+    for name in _ENGINES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        versions.append("%s=%s" % (name, getattr(module, "__version__", "")))
+    return ";".join(versions).encode("utf8")
+
+
+def _canonicalRepr(value):
+    """ Return the repr of *value*, but with the items of sets and dicts
+    sorted and code replaced by a digest of its source, so that equal values
+    are spelled the same in every process. Raises TypeError for an object
+    whose repr shows its address, which differs from run to run. """
+    if isinstance(value, (set, frozenset)):
+        return "%s({%s})" % (type(value).__name__,
+                             ", ".join(sorted(map(_canonicalRepr, value))))
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(sorted(
+                "%s: %s" % (_canonicalRepr(k), _canonicalRepr(v))
+                for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return "%s(%s)" % (type(value).__name__,
+                           ", ".join(map(_canonicalRepr, value)))
+    if inspect.ismodule(value) or callable(value):
+        return "code(%s)" % hashlib.sha256(_source(value)).hexdigest()
+    text = repr(value)
+    if re.search(r" at 0x[0-9a-fA-F]+>", text):
+        raise TypeError("Can't fingerprint %s: its repr changes from run to "
+                        "run" % text)
+    return text
+
+
+def _updateWithInput(digest, value):
+    """ Fold one build input into *digest*: files by their contents,
+    functions, classes and modules by their source code, and anything else
+    by its :func:`canonical repr <_canonicalRepr>`. """
+    if isinstance(value, os.PathLike) or (isinstance(value, str) and
+                                          os.path.isfile(value)):
+        path = os.fspath(value)
+        digest.update(b"file\0" + path.encode("utf8") + b"\0")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+    elif inspect.ismodule(value) or callable(value):
+        digest.update(b"code\0" + _source(value))
+    else:
+        digest.update(b"value\0" + _canonicalRepr(value).encode("utf8"))
+    digest.update(b"\0")
+
+
+def fingerprint(name, fn, inputs=(), args=(), kwargs=None):
+    """ Return a hex digest identifying a build: its name, the code of the
+    building function *fn*, its *inputs* and the arguments it is called
+    with, along with the cache format and the engine library versions. """
+    digest = hashlib.sha256(_FORMAT + b"\0" + _engineVersions() + b"\0" +
+                            name.encode("utf8") + b"\0")
+    _updateWithInput(digest, fn)
+    for value in inputs:
+        _updateWithInput(digest, value)
+    _updateWithInput(digest, args)
+    _updateWithInput(digest, sorted((kwargs or {}).items()))
+    return digest.hexdigest()
+
+
+def _entries(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    entries = []
+    for filename in names:
+        if filename.endswith(".pickle"):
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _evict(directory, maxBytes, keep):
+    """ Delete the least recently used entries in *directory* until it holds
+    at most *maxBytes*, never deleting *keep*. """
+    entries = sorted(_entries(directory))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= maxBytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _store(directory, path, result):
+    """ Write *result* to *path* atomically, so that a concurrent reader
+    never sees a partly written entry. """
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def cached_build(name, inputs=(), cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Decorator caching the container returned by a function that builds a
+    grammar. The cache key fingerprints *name*, the function's source code,
+    every item of *inputs* (files by their contents, functions and modules
+    by their source, other values by their repr, with sets and dicts
+    sorted) and the arguments the function is called with, as well as the
+    versions of Pynini and NumPy. Values whose repr shows their address
+    can't be fingerprinted, and raise TypeError. On a hit the container is loaded from
+    *cache_dir* (by default :func:`default_cache_dir`), and the function is
+    not called. Entries are pickled, so compiled machines are stored in
+    OpenFst's binary format. Once the directory holds more than *max_bytes*,
+    the least recently used entries are deleted.
+
+    Code that the function calls is not fingerprinted unless it is listed in
+    *inputs*; listing the building script's own ``__file__`` is the simplest
+    way to catch every change.
+
+        >>> @cached_build("vowels", inputs=[__file__])  # doctest: +SKIP
+        ... def vowels():
+        ...     return fsa("a e i o u".split()).star()
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def innerFunction(*args, **kwargs):
+            directory = cache_dir or default_cache_dir()
+            key = fingerprint(name, fn, inputs, args, kwargs)
+            path = os.path.join(directory, "%s-%s.pickle" % (name, key))
+            try:
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+            except Exception:
+                # A missing, corrupt or unreadable entry, or one naming code
+                # that has since moved or changed, is rebuilt and replaced.
+                pass
+            else:
+                os.utime(path)
+                return result
+            result = fn(*args, **kwargs)
+            _store(directory, path, result)
+            _evict(directory, max_bytes, keep=path)
+            return result
+        return innerFunction
+    return decorator
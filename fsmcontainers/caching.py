@@ -0,0 +1,69 @@
+""" Bounded, thread-safe caches for lookup results. """
+
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions",
+                                     "maxsize", "currsize",
+                                     "maxbytes", "currbytes"])
+
+
+class LookupCache(object):
+    """ A least-recently-used cache holding at most *maxsize* entries and, if
+    *maxbytes* is given, at most roughly that many bytes of keys and values,
+    as measured by *sizeof*. Safe to share between threads. """
+
+    def __init__(self, maxsize=4096, maxbytes=None, sizeof=sys.getsizeof):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ Return the cached value for *key*, or call *compute* to get it and
+        cache the result. *compute* runs outside the lock, so a slow lookup
+        does not hold up other threads; two threads missing on the same key at
+        once may both compute it. Exceptions are not cached. """
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = compute()
+        size = self.sizeof(key) + self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict()
+        return value
+
+    def _evict(self):
+        while self._entries and (
+                len(self._entries) > self.maxsize or
+                (self.maxbytes is not None and self._bytes > self.maxbytes)):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._entries),
+                             self.maxbytes, self._bytes)
@@ -1,14 +1,31 @@
-from itertools import chain
-from collections import Mapping, Iterable
+from itertools import chain, islice
+from collections.abc import Mapping, Iterable
 from numbers import Number
+import functools
 import operator
-from .wrappers import PyniniWrapper
+import random
+import sys
+from .wrappers import PyniniWrapper, wrapPairs, convertEngine
 from .serializers import Serializer
+from .caching import LookupCache
+from . import aio
+from .buildcache import cached_build
+from .parallel import compile_parallel, balancedReduce
+from . import graph
+from .settings import (ResourceLimitError, resource_limits,
+                       set_resource_limits, optimization_level,
+                       set_optimization_level, get_optimization_level,
+                       set_hash_engine_limit)
 
 SIGMA = list("qwertyuiopasdfghjkl;'zxcvbnm,./`1234567890-=QWERTYUIOP{}|ASDFGHJKL:\"ZXCVBNM<>?~!@#$%^&*()_+ ")
 
 class fsmcontainer(object):
-    """ Abstract base class for containerlike fst and fsa objects. """
+    """ Abstract base class for containerlike fst and fsa objects.
+
+    Instances are immutable (apart from :class:`mutablefsa` and
+    :class:`mutablefst`), and any number of threads may read from one
+    instance at once. Lookups against a :meth:`frozen <freeze>` instance walk
+    a shared, read-only copy of its states and arcs, and take no locks. """
     def __init__(self, *args, **kwargs):
         """ To be implemented by subclasses. """
         return NotImplemented
@@ -28,8 +45,21 @@ class fsmcontainer(object):
             kproto, vproto = ("", "")
         self.keySerializer = Serializer.from_prototype(kproto)
         self.valueSerializer = Serializer.from_prototype(vproto)
-        self.fsm = PyniniWrapper.fromPairs(self._serializePair(p)
-                                            for p in pairs)
+        self.fsm = wrapPairs(self._serializePair(p) for p in pairs)
+
+    def _initializeWithTriples(self, triples):
+        """ Like :meth:`_initializeWithPairs`, for a sequence of (k,v,weight)
+        triples. """
+        try:
+            first = next(triples)
+            kproto, vproto, _ = first
+            triples = chain([first], triples)
+        except StopIteration:
+            kproto, vproto = ("", "")
+        self.keySerializer = Serializer.from_prototype(kproto)
+        self.valueSerializer = Serializer.from_prototype(vproto)
+        self.fsm = PyniniWrapper.fromTriples(
+                self._serializePair((k, v)) + (w,) for k, v, w in triples)
 
     def _initializeWithAttributes(self, fsm,
             keySerializer=Serializer.from_prototype(""),
@@ -102,15 +132,16 @@ class fsmcontainer(object):
     def union(self, *others):
         """
         Return an fsm containing all the items from *self* and all the
-        items from each of the *others*.
+        items from each of the *others*. The machines are merged pairwise in
+        a balanced tree, so a union of many items costs n log n rather than
+        n squared; see :func:`compile_parallel` for building them in
+        parallel.
         """
-        obj = self.copy()
         cls = type(self)
         if len(others) == 1 and isinstance(others[0], Iterable):
             others = others[0]
-        for other in others:
-            obj = obj | cls(other)
-        return obj
+        return balancedReduce(operator.or_,
+                              chain([self.copy()], (cls(o) for o in others)))
 
     def _binaryOp(self, other, op):
         """
@@ -157,7 +188,59 @@ class fsmcontainer(object):
         Return true if this instance has *keyOrElement* as an element (for
         `fsa`) or as a key (for `fst`).
         """
-        return self.fsm.accepts(self.keySerializer.serialize(keyOrElement))
+        return self._cachedLookup("contains", keyOrElement,
+                                  lambda: self._contains(keyOrElement))
+
+    def _contains(self, keyOrElement):
+        serialized = self.keySerializer.serialize(keyOrElement)
+        if self.frozen:
+            return graph.accepts(self.fsm.graph(), graph.tokenize(serialized))
+        return self.fsm.accepts(serialized)
+
+    lookupCache = None
+
+    def with_lookup_cache(self, maxsize=4096, maxbytes=None):
+        """
+        Return a copy of the current instance with a bounded
+        least-recently-used cache in front of membership tests and (for
+        :class:`fst`) lookups and queries. Holds at most *maxsize* results
+        and, if *maxbytes* is given, roughly that many bytes of keys and
+        results. Since instances are immutable, cached results never go
+        stale. The cache is safe to share between threads.
+
+        >>> d = fst({'a': '1'}).with_lookup_cache(maxsize=100)
+        >>> d['a'], d['a']
+        ('1', '1')
+        >>> d.lookup_cache_info().hits
+        1
+        """
+        obj = self.copy()
+        obj.lookupCache = LookupCache(maxsize, maxbytes, sizeof=_resultSize)
+        return obj
+
+    def lookup_cache_info(self):
+        """ Return hit, miss and eviction counts and current sizes for the
+        cache added by :meth:`with_lookup_cache`, or None if there is none.
+        """
+        if self.lookupCache is None:
+            return None
+        return self.lookupCache.info()
+
+    def _cachedLookup(self, kind, key, compute, keySet=False):
+        """ Return the result of *compute* for a lookup of *key*, through the
+        lookup cache if there is one. Lookups are cached under the exact
+        key, so that tuple keys in different orders stay apart; with
+        *keySet*, a non-string *key* is a collection of keys, as in
+        :meth:`fst.query`, and is cached as a set. """
+        if self.lookupCache is None:
+            return compute()
+        if keySet and not isinstance(key, str) and isinstance(key, Iterable):
+            key = frozenset(key)
+        try:
+            hash(key)
+        except TypeError:
+            return compute()
+        return self.lookupCache.get((kind, key), compute)
 
     def __len__(self):
         """
@@ -239,7 +322,19 @@ class fsmcontainer(object):
         # TODO: also check that self and other have compatible serialization
         # protocols.
 
+    def __getstate__(self):
+        # Caches and asyncio machinery hold locks and event loops, and are
+        # rebuilt on demand after unpickling.
+        state = self.__dict__.copy()
+        for name in ("lookupCache", "_asyncDispatchers", "asyncExecutor",
+                     "asyncInProcess", "asyncOwnsExecutor"):
+            state.pop(name, None)
+        return state
+
     def copy(self):
+        """ Return a copy of the current instance. The copy shares the
+        wrapped machine, which is never modified in place, so copying is
+        cheap regardless of the size of the machine. """
         cls = type(self)
         return cls.fromAttributes(self.fsm,
                                   self.keySerializer,
@@ -253,6 +348,13 @@ class fsmcontainer(object):
         cls = type(self).__name__
         return f"{cls}([{contents}])"
 
+    def _weightedRepr(self):
+        contents = list(self.weighted_items(limit=5))
+        coda = " ... " if len(contents) > 4 else ""
+        contents = ", ".join(map(repr, contents[:4])) + coda
+        cls = type(self).__name__
+        return f"{cls}([{contents}])"
+
     def star(self):
         """
         Return an :class:`fsa` whose elements are made by concatenating
@@ -291,8 +393,96 @@ class fsmcontainer(object):
         return cls.fromAttributes(self.fsm.plus(), self.keySerializer,
                 self.valueSerializer)
 
+    def optimize(self, level="full"):
+        """
+        Return a copy of the current instance whose machine is optimized to
+        *level*. Constructive operations only apply the level set with
+        :func:`set_optimization_level` (by default a cheap epsilon-removal and
+        trim), so a grammar can be built quickly and then finalized once,
+        with ``"full"`` determinization and minimization, before deployment.
+
+             >>> with optimization_level("none"):
+             ...     a = fsa({'a', 'b'}).star() + fsa('c')
+             >>> b = a.optimize()
+             >>> a == b
+             True
+        """
+        cls = type(self)
+        return cls.fromAttributes(self.fsm.optimize(level), self.keySerializer,
+                self.valueSerializer)
+
+    def prepare_for_composition(self, lookahead=False):
+        """
+        Arc-sort the current instance's machine for use on either side of a
+        composition, and cache the sorted machines so that repeated
+        compositions and lookups against it do not sort it again. With
+        *lookahead*, also convert the left-hand machine to OpenFst's
+        label-lookahead form, if OpenFst was built with that extension.
+        Returns the current instance.
+        """
+        self.fsm.prepareForComposition(lookahead)
+        return self
+
+    def freeze(self, lookahead=False):
+        """
+        Return a copy of the current instance compiled for serving: fully
+        optimized and prepared for composition (see
+        :meth:`prepare_for_composition`). Lookups against a frozen instance
+        never redo that work. Membership tests and ``[]`` lookups walk a
+        pure-Python table of the machine's states and arcs instead of
+        building and composing a machine for each key, so they allocate
+        nothing in OpenFst and share no mutable state between threads.
+
+        OpenFst's Python bindings hold the GIL, so threads sharing a frozen
+        instance do not run lookups in parallel. To spread lookups across
+        cores, use a process pool (see :meth:`fst.with_executor`).
+        """
+        cls = type(self)
+        obj = cls.fromAttributes(self.fsm.optimized(), self.keySerializer,
+                self.valueSerializer)
+        obj.frozen = True
+        obj.fsm.graph()
+        return obj.prepare_for_composition(lookahead)
+
+    frozen = False
+
+    def with_engine(self, engine):
+        """
+        Return a copy of the current instance whose machine is held by
+        *engine*:
+
+        * ``"pynini"``: an OpenFst machine built by Pynini.
+        * ``"array"``: NumPy arrays of states and arcs (unweighted). Needs
+          only NumPy, so precompiled machines saved in this form can be
+          served without installing Pynini.
+        * ``"set"``: a Python set of items, for small finite containers.
+
+        Converting to ``"set"``, or from ``"array"`` to ``"pynini"``, only
+        works for finite containers.
+
+        >>> a = fsa('cat', 'dog').with_engine('array')
+        >>> 'cat' in a, 'cow' in a
+        (True, False)
+        """
+        cls = type(self)
+        obj = cls.fromAttributes(convertEngine(self.fsm, engine),
+                                 self.keySerializer, self.valueSerializer)
+        obj.frozen = self.frozen
+        return obj
+
     def write(self, filename):
-        self.fsm.fsm.write(filename)
+        """ Write the current instance's machine to *filename*: as an OpenFst
+        binary file, or, for the array engine, as a NumPy ``.npz`` file. """
+        self.fsm.write(filename)
+
+def _resultSize(obj):
+    """ Rough size in bytes of a cached lookup key or result. Machines are
+    counted by their number of states and arcs. """
+    if isinstance(obj, fsmcontainer):
+        return 64 * (obj.fsm.numStates() + obj.fsm.numArcs())
+    if isinstance(obj, (tuple, frozenset)):
+        return sys.getsizeof(obj) + sum(_resultSize(x) for x in obj)
+    return sys.getsizeof(obj)
 
 class fsa(fsmcontainer):
     """
@@ -358,35 +548,69 @@ class fsa(fsmcontainer):
     def __repr__(self):
         return self._repr(side="top")
 
+    def difference_witness(self, other):
+        """
+        Return an element of the current instance that is not in *other*, or
+        None if there is none. The search walks both machines side by side
+        and stops at the first witness, so the difference is never built,
+        and the answer comes quickly when there is one.
+
+        >>> fsa('a', 'bb', 'c').difference_witness(fsa('c'))
+        'a'
+        >>> fsa('a').difference_witness(fsa('a', 'b')) is None
+        True
+        """
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return self.intersection_witness(other.complemented)
+        self._typecheck(other)
+        return self._inflateWitness(self.fsm.differenceWitness(other.fsm))
+
+    def intersection_witness(self, other):
+        """
+        Return an element of both the current instance and *other*, or None
+        if there is none, without building the intersection.
+
+        >>> fsa('a', 'b').intersection_witness(fsa('b', 'c'))
+        'b'
+        """
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return self.difference_witness(other.complemented)
+        self._typecheck(other)
+        return self._inflateWitness(self.fsm.intersectionWitness(other.fsm))
+
+    def _inflateWitness(self, witness):
+        return None if witness is None else self._inflateKey(witness)
+
     def isdisjoint(self, other):
-        return not self.fsm.intersect(other.fsm).hasPaths()
+        return self.intersection_witness(other) is None
 
     def issubset(self, other):
-        return not self.fsm.subtract(other.fsm).hasPaths()
+        return self.difference_witness(other) is None
 
     def issuperset(self, other):
-        return not other.fsm.subtract(self.fsm).hasPaths()
+        return _acceptor(other).issubset(self)
 
     def __le__(self, other):
         return self.issubset(other)
 
     def __lt__(self, other):
-        return self.issubset(other) and not self == other
+        return self.issubset(other) and not self.issuperset(other)
 
     def __ge__(self, other):
         return self.issuperset(other)
 
     def __gt__(self, other):
-        return self.issuperset(other) and not self == other
+        return self.issuperset(other) and not self.issubset(other)
 
     def __sub__(self, other):
         return self._binaryOp(other, op=self.fsm.subtract)
 
     def difference(self, *others):
         obj = self.copy()
-        cls = type(self)
         for other in others:
-            obj = obj - cls(other)
+            obj = obj - _acceptor(other)
         return obj
 
     def __and__(self, other):
@@ -394,9 +618,8 @@ class fsa(fsmcontainer):
 
     def intersection(self, *others):
         obj = self.copy()
-        cls = type(self)
         for other in others:
-            obj = obj & cls(other)
+            obj = obj & _acceptor(other)
         return obj
 
     def __xor__(self, other):
@@ -428,7 +651,8 @@ class fsa(fsmcontainer):
 
     def __invert__(self):
         """
-        Return an :class:`fst` containing all strings not in this one.
+        Return a :class:`complementfsa` containing all strings not in this
+        one. No machine is built unless one is needed.
 
         >>> 'a' in ~fsa('a')
         False
@@ -437,8 +661,189 @@ class fsa(fsmcontainer):
         >>> 'asdfkhasdfkasdfhkjlasdhkasdjfas' in ~fsa('a')
         True
         """
-        cls = type(self)
-        return cls(SIGMA).star() - self
+        return complementfsa(self)
+
+    def fuzzy_lookup(self, word, max_distance=1, limit=None):
+        """
+        Return a list of *(element, distance)* pairs for the elements within
+        Levenshtein distance *max_distance* of *word*, closest first, and at
+        most *limit* of them. Distances count insertions, deletions and
+        substitutions of single tokens. The search walks the acceptor
+        directly, pruning every branch that has strayed too far from *word*,
+        so no edit transducer is built and only a small part of a large
+        lexicon is visited.
+
+        >>> a = fsa('cat', 'cart', 'dog', 'coat')
+        >>> a.fuzzy_lookup('cat')
+        [('cat', 0), ('cart', 1), ('coat', 1)]
+        >>> a.fuzzy_lookup('cot', limit=1)
+        [('cat', 1)]
+        """
+        tokens = graph.tokenize(self._serializeKey(word))
+        matches = graph.fuzzyMatches(self.fsm.optimized().graph(), tokens,
+                                     max_distance)
+        return [(self._inflateKey(string), distance)
+                for string, distance in matches[:limit]]
+
+    def has_prefix(self, prefix):
+        """
+        Return True if some element of the current instance starts with
+        *prefix*. Only the states along *prefix* are visited, so the cost
+        does not depend on the size of the acceptor. *prefix* may end
+        partway through a bracketed token.
+
+        >>> a = fsa('cat', 'car', 'dog')
+        >>> a.has_prefix('ca'), a.has_prefix('co')
+        (True, False)
+        """
+        stateGraph = self.fsm.optimized().graph()
+        live = stateGraph.finalDistances()
+        return any(state in live for state, _ in
+                   self._prefixStates(stateGraph, prefix))
+
+    def _prefixStates(self, stateGraph, prefix):
+        """ The ``(state, labels)`` pairs reached by reading *prefix*, which
+        may end partway through a token (see :func:`graph.splitPrefix`). """
+        partial = ""
+        if isinstance(prefix, str):
+            prefix, partial = graph.splitPrefix(prefix)
+        tokens = graph.tokenize(self._serializeKey(prefix))
+        return graph.prefixStates(stateGraph, tokens, partial)
+
+    def completions(self, prefix="", limit=None, rank=None):
+        """
+        Return an iterator over at most *limit* elements that start with
+        *prefix*. The iterator walks to the state reached by *prefix* and
+        then enumerates suffixes lazily, so each keystroke of an
+        autocomplete costs time proportional to the prefix and the number of
+        completions taken, not to the size of the acceptor.
+
+        By default, shorter completions come first. With ``rank="weight"``,
+        completions come lowest weight first (see :class:`wfsa`), using a
+        best-path distance for each state that is computed once per acceptor.
+
+        >>> a = fsa('cat', 'car', 'cart', 'dog')
+        >>> list(a.completions('ca'))
+        ['car', 'cat', 'cart']
+        >>> w = wfsa({'cat': 3, 'car': 1, 'cart': 2})
+        >>> list(w.completions('ca', limit=2, rank='weight'))
+        ['car', 'cart']
+        """
+        stateGraph = self.fsm.optimized().graph()
+        starts = self._prefixStates(stateGraph, prefix)
+        if rank is None:
+            strings = graph.completions(stateGraph, starts)
+        elif rank == "weight":
+            strings = (string for string, _ in
+                       graph.rankedCompletions(stateGraph, starts))
+        else:
+            raise ValueError("rank must be None or 'weight', not %r" % rank)
+        return (self._inflateKey(string)
+                for string in islice(strings, limit))
+
+    def index(self, element):
+        """
+        Return the position of *element* among the elements of the current
+        instance in sorted order, from 0 to ``len(self) - 1``. Elements are
+        compared token by token, so a bracketed token such as ``[ab]`` sorts
+        as a single symbol. Together with
+        :meth:`word_at`, this makes a finite acceptor a compact, ordered
+        dictionary from strings to dense integer ids (a minimal perfect
+        hash): the ids come from counts of the paths through each state of
+        the minimal acceptor, so no strings are stored on the side, and a
+        lookup takes one step per token of *element*.
+
+        Raises KeyError if *element* is not in the current instance, and
+        ValueError if the current instance is cyclic.
+
+        >>> a = fsa('cat', 'car', 'dog')
+        >>> a.index('cat')
+        1
+        >>> a.word_at(1)
+        'cat'
+        """
+        try:
+            return graph.indexOf(self.fsm.optimized().graph(),
+                                 graph.tokenize(self._serializeKey(element)))
+        except KeyError:
+            raise KeyError(element) from None
+
+    def word_at(self, i):
+        """
+        Return the element at position *i* in sorted order; the inverse of
+        :meth:`index`. Negative positions count from the end. Raises
+        IndexError if *i* is out of range.
+        """
+        labels = graph.stringAt(self.fsm.optimized().graph(), i)
+        return self._inflateKey(graph.detokenize(labels))
+
+    def finditer(self, text, overlapping=False, longest=True):
+        """
+        Yield a *(start, end, match)* triple for each occurrence of an
+        element of the current instance in the string *text*, where *match*
+        is ``text[start:end]``, in order of *start*. The text is scanned once,
+        however many elements there are. By default matches do not overlap:
+        the leftmost is taken first, and the longest one starting there.
+        Without *longest*, the shortest is taken instead. With *overlapping*,
+        every position gets its longest match, or, without *longest*, every
+        match is reported. The empty string never matches.
+
+        >>> lexicon = fsa('he', 'she', 'his', 'hers')
+        >>> list(lexicon.finditer('ushers'))
+        [(1, 4, 'she')]
+        >>> list(lexicon.finditer('ushers', overlapping=True, longest=False))
+        [(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')]
+        """
+        return self.finditer_stream([text], overlapping, longest)
+
+    def finditer_stream(self, chunks, overlapping=False, longest=True):
+        """
+        Like :meth:`finditer`, for a text given as an iterable of string
+        *chunks*, such as the lines of a file. Positions count from the
+        start of the whole text, matches may cross chunk boundaries, and
+        only text that a match could still need is kept in memory. Each
+        match is yielded as soon as no later input can change it.
+        """
+        scanner = graph.MatchScanner(self.fsm.optimized().graph(),
+                                     overlapping=overlapping, longest=longest)
+        kept, keptFrom = "", 0     # Text from offset keptFrom onwards.
+        boundaries = [0]           # Offset of each token boundary.
+        boundariesFrom = 0         # Token position of boundaries[0].
+        for text, spans, final in _chunkTokens(chunks):
+            kept += text
+            boundaries.extend(end for _, _, end in spans)
+            settled = scanner.feed(token for token, _, _ in spans)
+            if final:
+                settled += scanner.close()
+            for start, end in settled:
+                start = boundaries[start - boundariesFrom]
+                end = boundaries[end - boundariesFrom]
+                yield (start, end,
+                       self._inflateKey(kept[start - keptFrom:end - keptFrom]))
+            horizon = scanner.horizon() - boundariesFrom
+            if horizon > 0:
+                del boundaries[:horizon]
+                boundariesFrom += horizon
+                kept = kept[boundaries[0] - keptFrom:]
+                keptFrom = boundaries[0]
+
+    def sample(self, k=1, seed=None, max_length=None):
+        """
+        Return a list of *k* elements drawn uniformly at random, with
+        replacement. Each draw walks one path, choosing arcs in proportion
+        to the number of elements they lead to, so the language is never
+        enumerated and millions of draws are cheap. A cyclic acceptor needs
+        *max_length*: elements of at most that many tokens are then drawn
+        uniformly. *seed* makes the draws repeatable.
+
+        >>> a = fsa('cat', 'car', 'dog')
+        >>> set(a.sample(20, seed=1)) <= {'cat', 'car', 'dog'}
+        True
+        >>> len(fsa('ab').star().sample(5, max_length=4))
+        5
+        """
+        pairs = self.fsm.samplePaths(k, random.Random(seed), max_length)
+        return [self._inflateKey(key) for key, _ in pairs]
 
     def becomes(self, other):
         this = self.fsm
@@ -501,16 +906,123 @@ class fst(fsmcontainer):
             self._initializeWithPairs(pairs)
 
     @classmethod
-    def read(cls, filename):
-        return cls.fromAttributes(PyniniWrapper.fromFilename(filename),
+    def read(cls, filename, freeze=False):
+        """ Read a compiled transducer from *filename*. With *freeze*, the
+        result is frozen (see :meth:`freeze`), which costs a full
+        optimization when it is read but speeds up lookups against it.
+        Files ending in ``.npz`` are read with the NumPy array engine (see
+        :meth:`with_engine`), which does not need Pynini. """
+        if filename.endswith(".npz"):
+            from .arrays import ArrayWrapper
+            fsm = ArrayWrapper.fromFilename(filename)
+        else:
+            fsm = PyniniWrapper.fromFilename(filename)
+        obj = cls.fromAttributes(fsm,
                 Serializer.from_prototype(""),
                 Serializer.from_prototype(""))
+        return obj.freeze() if freeze else obj
 
     def __repr__(self):
         return self._repr(side="both")
 
     def __getitem__(self, key):
-        return next(iter(self.query({key})))
+        return self._cachedLookup("getitem", key, lambda: self._getitem(key))
+
+    def _getitem(self, key):
+        if self.frozen:
+            value = graph.transduce(self.fsm.graph(),
+                                    graph.tokenize(self._serializeKey(key)))
+            if value is None:
+                raise KeyError(key)
+            return self._inflateValue(value)
+        try:
+            return next(iter(self._query({key})))
+        except StopIteration:
+            raise KeyError(key) from None
+
+    asyncExecutor = None
+    asyncInProcess = True
+    asyncOwnsExecutor = False
+    asyncMaxPending = aio.DEFAULT_MAX_PENDING
+
+    def with_executor(self, executor="thread", workers=None,
+                      max_pending=aio.DEFAULT_MAX_PENDING):
+        """
+        Return a copy of the current instance whose asynchronous lookups
+        (:meth:`aget` and friends) run in *executor*: ``"thread"`` for a new
+        thread pool, ``"process"`` for a new process pool, each worker of
+        which receives a copy of the instance once, when it starts, or any
+        :class:`concurrent.futures.Executor`. At most *max_pending* lookups
+        are in the executor at once; further requests wait their turn.
+        Without this, asynchronous lookups use the event loop's default
+        executor.
+
+        A pool created here belongs to the returned instance: shut it down
+        with :meth:`close`, or by using the instance as a context manager.
+        An executor passed in is left for the caller to shut down.
+
+        >>> import asyncio
+        >>> with fst({'a': '1'}).with_executor(workers=2) as d:
+        ...     asyncio.run(d.aget('a'))
+        '1'
+        """
+        obj = self.copy()
+        (obj.asyncExecutor, obj.asyncInProcess,
+         obj.asyncOwnsExecutor) = aio.makeExecutor(obj, executor, workers)
+        obj.asyncMaxPending = max_pending
+        return obj
+
+    def close(self):
+        """ Shut down the pool created for the current instance by
+        :meth:`with_executor`, if any, after the lookups running in it
+        finish. Later asynchronous lookups use the event loop's default
+        executor. """
+        executor, owned = self.asyncExecutor, self.asyncOwnsExecutor
+        for name in ("_asyncDispatchers", "asyncExecutor", "asyncInProcess",
+                     "asyncOwnsExecutor"):
+            self.__dict__.pop(name, None)
+        if owned:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def aget(self, key):
+        """
+        Look up *key* without blocking the event loop, by running the lookup
+        in an executor (see :meth:`with_executor`). Concurrent requests for
+        the same key share one lookup.
+
+        >>> import asyncio
+        >>> d = fst({'a': '1'})
+        >>> asyncio.run(d.aget('a'))
+        '1'
+        """
+        return await aio.dispatcher(self).submit("getitem", key)
+
+    async def aquery(self, querySet):
+        """ Asynchronous version of :meth:`query`, dispatched like
+        :meth:`aget`. """
+        return await aio.dispatcher(self).submit("query", querySet)
+
+    async def aget_many(self, keys):
+        """ Look up every key in *keys* in a single executor job, and return
+        the values in the same order. Cheaper than many :meth:`aget` calls
+        when each lookup is fast. """
+        return await aio.dispatcher(self).batch(keys)
+
+    def astream(self, keys):
+        """
+        Return an asynchronous iterator of ``(key, value)`` pairs for the
+        keys of *keys*, which may be an ordinary or an asynchronous iterable,
+        in order. Lookups run ahead of the consumer, but never more than the
+        pending limit set by :meth:`with_executor`, so a slow consumer stops
+        *keys* from being drawn.
+        """
+        return aio.dispatcher(self).stream(keys)
 
     def __matmul__(self, other):
         return self._productOp(other, self.fsm.compose, cls=type(self))
@@ -535,8 +1047,7 @@ class fst(fsmcontainer):
         return other._productOp(self, other.fsm.compose, cls=type(self))
 
     def _pu(self, other):
-        cls = type(self)
-        return self | (~self.keyset() @ cls(other))
+        return self.priority_union(other)
 
     def __rshift__(self, other):
         return self._pu(other)
@@ -572,12 +1083,19 @@ class fst(fsmcontainer):
            fst([('a', '1'), ('b', '1'), ('c', '2'), ('d', '3')])
            >>> f << g << h
            fst([('a', '2'), ('b', '3'), ('c', '3'), ('d', '3')])
+
+        All of the *others* are combined in one pass, rather than one
+        priority union at a time.
         """
-        obj = self.copy()
         cls = type(self)
-        for other in others:
-            obj = obj >> cls(other)
-        return obj
+        others = [cls(other) for other in others]
+        if not others:
+            return self.copy()
+        self._typecheck(*others)
+        return cls.fromAttributes(
+                fsm=self.fsm.priorityUnion(*(other.fsm for other in others)),
+                keySerializer=self.keySerializer,
+                valueSerializer=self.valueSerializer)
 
     def query(self, querySet):
         """
@@ -594,19 +1112,49 @@ class fst(fsmcontainer):
             >>> d.query({'I', 'III'})
             fsa(['one', 'three'])
         """
+        return self._cachedLookup("query", querySet,
+                                  lambda: self._query(querySet), keySet=True)
+
+    def _query(self, querySet):
         return (fsa(querySet) @ self).valueset()
 
+    @property
+    def inv(self):
+        """
+        The inverse of the current instance, mapping each value to the keys
+        that map to it. The inverse is a lazy view: it shares the machine of
+        the current instance, and looking keys up in it does not build an
+        inverted copy of that machine.
+
+        >>> d = fst({'a': '1', 'b': '2'})
+        >>> d.inv['2']
+        'b'
+        >>> ~d == d.inv
+        True
+        >>> ~~d == d
+        True
+        """
+        cls = type(self)
+        return cls.fromAttributes(fsm=self.fsm.invert(),
+                                  keySerializer=self.valueSerializer,
+                                  valueSerializer=self.keySerializer)
+
+    def __invert__(self):
+        return self.inv
+
     def keys(self):
         return self._items(side="top")
 
     def keyset(self):
         """
         Return the keys in the current instance as an :class:`fsa` rather than
-        an iterator.
+        an iterator. The result is a lazy projection of the current instance's
+        machine, which is only copied if the result is used in an operation
+        that needs a machine of its own.
         """
         return fsa.fromAttributes(fsm=self.fsm.project(side="top"), 
-                                     keySerializer=self.valueSerializer,
-                                     valueSerializer=self.valueSerializer)
+                                     keySerializer=self.keySerializer,
+                                     valueSerializer=self.keySerializer)
 
     def values(self):
         return self._items(side="bottom")
@@ -614,7 +1162,7 @@ class fst(fsmcontainer):
     def valueset(self):
         """
         Return the values in the current instance as an :class:`fsa` rather than
-        an iterator.
+        an iterator. Like :meth:`keyset`, the result is a lazy projection.
         """
         return fsa.fromAttributes(fsm=self.fsm.project(side="bottom"), 
                                      keySerializer=self.valueSerializer,
@@ -623,16 +1171,523 @@ class fst(fsmcontainer):
     def items(self):
         return self._items(side="both")
 
+    def sample_items(self, k=1, seed=None, max_length=None):
+        """
+        Return a list of *k* *(key, value)* pairs drawn uniformly at random,
+        with replacement, as :meth:`fsa.sample` draws elements. Draws are
+        uniform over the paths of the optimized machine, which are its items
+        unless one item is spelled by paths that align its key and value
+        differently.
+        """
+        pairs = self.fsm.samplePaths(k, random.Random(seed), max_length)
+        return [self._inflatePair(pair) for pair in pairs]
+
+    def is_functional(self):
+        """
+        Return True if every key is mapped to at most one value. The test is
+        exact, and its result is cached.
+
+        >>> fst({'a': '1', 'b': '1'}).is_functional()
+        True
+        >>> fst([('a', '1'), ('a', '2')]).is_functional()
+        False
+        """
+        return self.fsm.isFunctional()
+
+    def find_ambiguity(self):
+        """
+        Return None if every key is mapped to at most one value. Otherwise
+        return a *(key, value1, value2)* triple showing a key that is mapped
+        to two different values.
+
+        >>> fst([('a', '1'), ('b', '2')]).find_ambiguity() is None
+        True
+        >>> k, v1, v2 = fst([('a', '1'), ('a', '2')]).find_ambiguity()
+        >>> (k, sorted([v1, v2]))
+        ('a', ['1', '2'])
+        """
+        witness = self.fsm.ambiguityWitness()
+        if witness is None:
+            return None
+        key, value1, value2 = witness
+        return (self._inflateKey(key), self._inflateValue(value1),
+                self._inflateValue(value2))
+
     def between(self, left="", right=""):
         left = fsa(left)
         right = fsa(right)
-        sigma = fsa(SIGMA).star()
+        sigma = _sigmaStar(tuple(SIGMA))
         self._typecheck(left, right)
         return fst.fromAttributes(
                 fsm = self.fsm.makeRewrite(left.fsm, right.fsm, sigma=sigma.fsm),
                 keySerializer = self.keySerializer,
                 valueSerializer = self.valueSerializer)
 
+    def rewrite_text(self, stream):
+        """
+        Apply the current instance, typically a rule compiled by
+        :meth:`between`, to a long text, and yield the output in pieces as
+        it is produced. *stream* is a string or an iterable of string chunks,
+        such as the lines of a file. Instead of composing the whole text
+        with the rule as one machine, the rule is run over the text one token
+        at a time, and output is yielded as soon as every way of reading the
+        input so far agrees on it. So only as much text is held at once as
+        the rule must look ahead to decide, which for a rewrite rule is the
+        length of its right context. Lookbehind costs nothing, since the
+        rule's states remember the left context. Where the rule allows more
+        than one output, the lowest-weight one is chosen.
+
+        Raises ValueError if the rule does not accept the text, for example
+        because it contains a symbol outside the rule's alphabet. Freezing
+        the rule first (see :meth:`freeze`) makes it smaller and faster to
+        run.
+
+        >>> rule = fst({'a': 'b'}).between(left='c')
+        >>> ''.join(rule.rewrite_text(['cac', 'aa']))
+        'cbcba'
+        """
+        if isinstance(stream, str):
+            stream = [stream]
+        batches = ([token for token, _, _ in spans]
+                   for _, spans, _ in _chunkTokens(stream))
+        for output in graph.transduceStream(self.fsm.graph(), batches):
+            yield self._inflateValue(output)
+
+@functools.lru_cache(maxsize=32)
+def _sigmaStarAt(alphabet, level):
+    return fsa(alphabet).star()
+
+def _sigmaStar(alphabet):
+    """ Return Sigma* over the tuple of symbols *alphabet*, building it
+    once for each alphabet and optimization level. Containers are
+    immutable, so the result is shared. """
+    return _sigmaStarAt(alphabet, get_optimization_level())
+
+def _chunkTokens(chunks):
+    """ Tokenize a text given as an iterable of string chunks. For each chunk,
+    and once more at the end, yield a *(text, spans, final)* triple: the text
+    newly available, holding back a partial token at its end until the next
+    chunk completes it; its :func:`graph.tokenSpans`, with offsets into the
+    whole text; and whether the input has ended. """
+    tail, offset = "", 0
+    for chunk in chain(chunks, [None]):
+        final = chunk is None
+        text = tail + (chunk or "")
+        cut = len(text)
+        if not final:
+            if "[" in text and "]" not in text[text.rindex("["):]:
+                cut = text.rindex("[")
+            escapes = cut - len(text[:cut].rstrip("\\"))
+            if escapes % 2:
+                cut -= 1
+        text, tail = text[:cut], text[cut:]
+        spans = [(token, offset + start, offset + end)
+                 for token, start, end in graph.tokenSpans(text)]
+        offset += len(text)
+        yield text, spans, final
+
+def _acceptor(obj):
+    return obj if isinstance(obj, fsa) else fsa(obj)
+
+class complementfsa(fsa):
+    """
+    The complement of the :class:`fsa` *complemented*: every string that is
+    not one of its elements. Returned by ``~a``.
+
+    The complement is symbolic. Membership is answered as non-membership in
+    *complemented*, and intersections, differences and unions with other
+    acceptors are rewritten as operations on *complemented*, so none of them
+    builds Sigma* or a complement machine:
+
+      >>> vowels = fsa('a', 'e', 'i', 'o', 'u')
+      >>> sorted(fsa('a', 'b', 'é') & ~vowels)
+      ['b', 'é']
+      >>> sorted(fsa('a', 'b') - ~vowels)
+      ['a']
+      >>> 'b' in ~vowels - fsa('b')
+      False
+
+    Iteration, ``len``, composition, concatenation and the like need a
+    machine, and build Sigma* minus *complemented* once, where Sigma is
+    *alphabet*: by default :data:`SIGMA` together with every symbol of
+    *complemented*. Their results are ordinary acceptors.
+    """
+
+    def __init__(self, complemented=(), alphabet=None):
+        self.complemented = _acceptor(complemented)
+        self.alphabet = alphabet
+        self.keySerializer = self.complemented.keySerializer
+        self.valueSerializer = self.complemented.valueSerializer
+        self._fsm = None
+
+    @classmethod
+    def fromAttributes(cls, fsm, keySerializer, valueSerializer):
+        # Operations on the materialized machine give ordinary acceptors.
+        return fsa.fromAttributes(fsm, keySerializer, valueSerializer)
+
+    @property
+    def fsm(self):
+        if self._fsm is None:
+            # Building the same machine twice in a race is harmless.
+            if self.alphabet is None:
+                sigma = fsa(SIGMA) | fsa.fromAttributes(
+                        self.complemented.fsm.sigma(),
+                        self.keySerializer, self.valueSerializer)
+            else:
+                sigma = fsa(self.alphabet)
+            self._fsm = (sigma.star() - self.complemented).fsm
+        return self._fsm
+
+    @fsm.setter
+    def fsm(self, value):
+        self._fsm = value
+
+    def copy(self):
+        return complementfsa(self.complemented, self.alphabet)
+
+    def __repr__(self):
+        return "~" + repr(self.complemented)
+
+    def _contains(self, element):
+        return element not in self.complemented
+
+    def __invert__(self):
+        return self.complemented.copy()
+
+    def _withComplemented(self, complemented):
+        return complementfsa(complemented, self.alphabet)
+
+    def __and__(self, other):
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return self._withComplemented(self.complemented |
+                                          other.complemented)
+        return other - self.complemented
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return self._withComplemented(self.complemented &
+                                          other.complemented)
+        return self._withComplemented(self.complemented - other)
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return other.complemented - self.complemented
+        return self._withComplemented(self.complemented | other)
+
+    def __rsub__(self, other):
+        return _acceptor(other) & self.complemented
+
+    def union(self, *others):
+        return functools.reduce(operator.or_, others, self)
+
+    def intersection(self, *others):
+        return functools.reduce(operator.and_, others, self)
+
+    def difference(self, *others):
+        return functools.reduce(operator.sub, others, self)
+
+    def concatenate(self, *others):
+        return fsa(self).concatenate(*others)
+
+    def difference_witness(self, other):
+        other = _acceptor(other)
+        if isinstance(other, complementfsa):
+            return other.complemented.difference_witness(self.complemented)
+        return fsa.difference_witness(self, other)
+
+    def intersection_witness(self, other):
+        other = _acceptor(other)
+        if not isinstance(other, complementfsa):
+            return other.difference_witness(self.complemented)
+        return fsa.intersection_witness(self, other)
+
+    def __eq__(self, other):
+        if isinstance(other, complementfsa):
+            return self.complemented == other.complemented
+        return fsa(self) == other
+
+def _isWeighted(entry, size):
+    """ Return True if *entry* is a tuple of *size* items ending in a weight.
+    Container elements are strings or tuples of strings, so a number in that
+    position cannot be part of an element. """
+    return (isinstance(entry, tuple) and len(entry) == size and
+            isinstance(entry[-1], Number))
+
+class wfsa(fsa):
+    """
+    Return a new weighted finite state acceptor. Like :class:`fsa`, but each
+    element has a weight, given by passing *(element, weight)* pairs or a
+    mapping from elements to weights. Elements given without a weight get
+    weight 0. Weights are tropical: lower is better, and an element given
+    more than once keeps its lowest weight.
+
+      >>> a = wfsa([('colour', 2), ('color', 1)])
+      >>> list(a.weighted_items())
+      [('color', 1.0), ('colour', 2.0)]
+      >>> 'colour' in a
+      True
+    """
+
+    def __init__(self, *items):
+        if len(items) == 1 and isinstance(items[0], fsa):
+            self._initializeAsCopy(items[0])
+            return
+        if len(items) == 1 and isinstance(items[0], Mapping):
+            items = list(items[0].items())
+        elif (len(items) == 1 and isinstance(items[0], Iterable) and not
+                isinstance(items[0], str)):
+            items = list(items[0])
+        items = (i if _isWeighted(i, 2) else (i, 0) for i in items)
+        self._initializeWithTriples((i, i, w) for i, w in items)
+
+    def __repr__(self):
+        return self._weightedRepr()
+
+    def weighted_items(self, limit=None):
+        """ Return an iterator over *(element, weight)* pairs, best (lowest
+        weight) first. With *limit*, only the *limit* best elements are
+        searched for, which is fast even for very large or cyclic acceptors.
+        """
+        return ((self._inflateKey(k), w) for k, w in
+                self.fsm.weightedPathIterator(limit=limit, side="top"))
+
+class wfst(fst):
+    """
+    Return a new weighted finite state transducer. Like :class:`fst`, but
+    each key-value pair has a weight, given by passing *(key, value, weight)*
+    triples. Pairs given without a weight, including those from a mapping or
+    keyword arguments, get weight 0. Weights are tropical: lower is better.
+
+    Subscripting returns the best value for a key, and :meth:`query` with *n*
+    returns the *n* best values with their weights.
+
+      >>> t = wfst([('teh', 'the', 1), ('teh', 'ten', 3), ('teh', 'tech', 2)])
+      >>> t['teh']
+      'the'
+      >>> t.query('teh', n=2)
+      [('the', 1.0), ('tech', 2.0)]
+    """
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > 1:
+            raise TypeError("wfst expected at most 1 arguments, got 2")
+        arg = args[0] if args else []
+        if isinstance(arg, (fst, fsa)):
+            self._initializeAsCopy(arg)
+        else:
+            if isinstance(arg, Mapping):
+                entries = arg.items()
+            else:
+                entries = arg.__iter__()
+            entries = chain(entries, kwargs.items())
+            self._initializeWithTriples(
+                    e if _isWeighted(e, 3) else tuple(e) + (0,)
+                    for e in entries)
+
+    def __repr__(self):
+        return self._weightedRepr()
+
+    def _getitem(self, key):
+        best = self.query(key, n=1)
+        if not best:
+            raise KeyError(key)
+        return best[0][0]
+
+    def query(self, querySet, n=None):
+        """
+        Without *n*, the same as :meth:`fst.query`. With *n*, return a list
+        of up to *n* *(value, weight)* pairs, best first, for the values that
+        correspond to any key in *querySet*. Only the part of the machine that
+        the keys reach is searched, and the search stops once it has found
+        the *n* best values.
+        """
+        if n is None:
+            return super().query(querySet)
+        return self._cachedLookup(("query", n), querySet,
+                                  lambda: self._nbest(querySet, n),
+                                  keySet=True)
+
+    def _nbest(self, querySet, n):
+        matches = fsa(querySet) @ self
+        return [(self._inflateValue(v), w) for v, w in
+                matches.fsm.weightedPathIterator(limit=n, side="bottom")]
+
+    def weighted_items(self, limit=None):
+        """ Return an iterator over *(key, value, weight)* triples, best
+        (lowest weight) first. With *limit*, only the *limit* best pairs are
+        searched for. """
+        return (self._inflatePair(kv) + (w,) for kv, w in
+                self.fsm.weightedPathIterator(limit=limit))
+
+class _mutablecontainer(object):
+    """
+    Mixin that makes an :class:`fsmcontainer` mutable at amortized constant
+    cost per change. The container keeps an immutable base machine plus a
+    small delta of added and removed items held in Python structures, which
+    answer lookups first. The delta is merged into the base machine, in a
+    single rebuild, when it grows past a fraction of the base's size, or as
+    soon as an operation needs the machine itself (set algebra, composition,
+    iteration, ``len``).
+    """
+
+    MIN_DELTA = 64
+    DELTA_FRACTION = 8
+
+    @property
+    def fsm(self):
+        if self._added or self._removed:
+            self._merge()
+        return self._base
+
+    @fsm.setter
+    def fsm(self, value):
+        self._base = value
+        self._added = self._emptyDelta()
+        self._removed = set()
+        if self.lookupCache is not None:
+            self.lookupCache.clear()
+        self._deltaLimit = max(self.MIN_DELTA,
+                               value.numStates() // self.DELTA_FRACTION)
+
+    def _changed(self):
+        if self.lookupCache is not None:
+            self.lookupCache.clear()
+        if len(self._added) + len(self._removed) > self._deltaLimit:
+            self._merge()
+
+    def _baseView(self):
+        """ An immutable container sharing the base machine, for answering
+        lookups that the delta cannot answer without merging it. """
+        return self._immutable.fromAttributes(self._base, self.keySerializer,
+                                              self.valueSerializer)
+
+    def clear(self):
+        cls = type(self)
+        self.fsm = cls().fsm
+
+
+class mutablefsa(_mutablecontainer, fsa):
+    """
+    A mutable :class:`fsa`, supporting the same methods as a built-in
+    :class:`set` for adding and removing elements.
+
+      >>> a = mutablefsa('one', 'two')
+      >>> a.add('three')
+      >>> a.discard('one')
+      >>> sorted(a)
+      ['three', 'two']
+    """
+
+    _immutable = fsa
+    _emptyDelta = set
+
+    def _merge(self):
+        base = self._base
+        if self._removed:
+            base = base.subtract(wrapPairs((x, x) for x in self._removed))
+        if self._added:
+            base = base.union(wrapPairs((x, x) for x in self._added))
+        self.fsm = base
+
+    def __contains__(self, element):
+        serialized = self._serializeKey(element)
+        if serialized in self._added:
+            return True
+        if serialized in self._removed:
+            return False
+        return element in self._baseView()
+
+    def add(self, element):
+        serialized = self._serializeKey(element)
+        self._removed.discard(serialized)
+        self._added.add(serialized)
+        self._changed()
+
+    def discard(self, element):
+        serialized = self._serializeKey(element)
+        self._added.discard(serialized)
+        if element in self._baseView():
+            self._removed.add(serialized)
+        self._changed()
+
+    def remove(self, element):
+        if element not in self:
+            raise KeyError(element)
+        self.discard(element)
+
+    def update(self, *iterables):
+        for iterable in iterables:
+            for element in iterable:
+                self.add(element)
+
+
+class mutablefst(_mutablecontainer, fst):
+    """
+    A mutable :class:`fst`. Assigning to a key replaces all of the values
+    it was mapped to, as with a built-in :class:`dict`.
+
+      >>> d = mutablefst({'a': '1', 'b': '2'})
+      >>> d['c'] = '3'
+      >>> del d['a']
+      >>> sorted(d.items())
+      [('b', '2'), ('c', '3')]
+    """
+
+    _immutable = fst
+    _emptyDelta = dict
+
+    def _merge(self):
+        base = self._base
+        if self._removed:
+            removed = wrapPairs((x, x) for x in self._removed)
+            domain = base.project(side="top").subtract(removed)
+            base = domain.compose(base)
+        if self._added:
+            base = base.union(wrapPairs(self._added.items()))
+        self.fsm = base
+
+    def __contains__(self, key):
+        serialized = self._serializeKey(key)
+        if serialized in self._added:
+            return True
+        if serialized in self._removed:
+            return False
+        return key in self._baseView()
+
+    def __getitem__(self, key):
+        serialized = self._serializeKey(key)
+        if serialized in self._added:
+            return self._inflateValue(self._added[serialized])
+        if serialized in self._removed:
+            raise KeyError(key)
+        return self._baseView()[key]
+
+    def __setitem__(self, key, value):
+        serialized = self._serializeKey(key)
+        self._removed.add(serialized)
+        self._added[serialized] = self._serializeValue(value)
+        self._changed()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        serialized = self._serializeKey(key)
+        self._added.pop(serialized, None)
+        self._removed.add(serialized)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        for key, value in fst(*args, **kwargs).items():
+            self[key] = value
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
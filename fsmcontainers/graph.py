@@ -0,0 +1,927 @@
+""" A read-only, pure-Python view of a machine's states and arcs, and
+algorithms that walk it directly instead of building new machines.
+
+Labels are stored as the text they stand for, with the empty string for
+epsilon, so graphs built from machines with different symbol tables can be
+walked side by side: a single character is its own label, unescaped, and a
+multi-character token is labelled with its bracketed text, such as
+``"[ab]"``. :func:`tokenize` splits a serialized string into labels, and
+:func:`detokenize` spells labels as a serialized string. """
+
+import heapq
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from os.path import commonprefix
+
+
+class StateGraph(object):
+    """ States are the integers ``0 .. numStates - 1``. ``arcs[state]`` is a
+    list of ``(ilabel, olabel, weight, nextstate)`` tuples, ``finals`` maps
+    each final state to its final weight, and ``start`` is the start state, or
+    None for a machine with no states. """
+
+    def __init__(self, start, arcs, finals):
+        self.start = start
+        self.arcs = arcs
+        self.finals = finals
+        self._inputIndex = {}
+        self._finalDistances = None
+        self._rankTable = None
+
+    @property
+    def numStates(self):
+        return len(self.arcs)
+
+    def arcsByInput(self, state):
+        """ Return a dict mapping each input label to the arcs leaving
+        *state* with that label. Built lazily, one state at a time. """
+        try:
+            return self._inputIndex[state]
+        except KeyError:
+            index = {}
+            for arc in self.arcs[state]:
+                index.setdefault(arc[0], []).append(arc)
+            self._inputIndex[state] = index
+            return index
+
+    def finalDistances(self):
+        """ Return a dict mapping every state from which a final state can be
+        reached to the weight of the best path from it to a final state,
+        final weight included. Computed once. """
+        if self._finalDistances is None:
+            self._finalDistances = _finalDistances(self)
+        return self._finalDistances
+
+
+    def rankTable(self):
+        """ Return the table used by :func:`indexOf` and :func:`stringAt`,
+        building it once. Raises ValueError if the graph is cyclic. """
+        if self._rankTable is None:
+            self._rankTable = _buildRankTable(self)
+        return self._rankTable
+
+
+def _finalDistances(graph):
+    # Label-correcting search backwards from the final states, which unlike
+    # Dijkstra's algorithm copes with negative arc weights.
+    incoming = [[] for _ in graph.arcs]
+    for state, stateArcs in enumerate(graph.arcs):
+        for arc in stateArcs:
+            incoming[arc[3]].append((state, arc[2]))
+    distances = dict(graph.finals)
+    queue = deque(distances)
+    queued = set(queue)
+    while queue:
+        state = queue.popleft()
+        queued.discard(state)
+        for previous, weight in incoming[state]:
+            distance = distances[state] + weight
+            if distance < distances.get(previous, float("inf")):
+                distances[previous] = distance
+                if previous not in queued:
+                    queued.add(previous)
+                    queue.append(previous)
+    return distances
+
+
+def _appendDelay(delay, out1, out2):
+    """ Extend a delay -- the outputs of one path not yet matched by the
+    other -- by one output label on each side, and cancel the common prefix.
+    Return None if the two sides have diverged for good. """
+    left, right = delay
+    if out1:
+        left = left + (out1,)
+    if out2:
+        right = right + (out2,)
+    i = 0
+    while i < len(left) and i < len(right) and left[i] == right[i]:
+        i += 1
+    left, right = left[i:], right[i:]
+    if left and right:
+        return None
+    return (left, right)
+
+
+def _squareEdges(graph, pair):
+    """ Yield ``(input, out1, out2, nextpair)`` for every way two paths can
+    advance together from *pair* while reading the same input. Epsilon-input
+    arcs advance one path at a time. """
+    p, q = pair
+    byInputQ = graph.arcsByInput(q)
+    for ilabel, olabel, _, nextp in graph.arcs[p]:
+        if ilabel == "":
+            yield ("", olabel, "", (nextp, q))
+        else:
+            for _, olabel2, _, nextq in byInputQ.get(ilabel, ()):
+                yield (ilabel, olabel, olabel2, (nextp, nextq))
+    for _, olabel2, _, nextq in byInputQ.get("", ()):
+        yield ("", "", olabel2, (p, nextq))
+
+
+def functionalityWitness(graph):
+    """ Decide exactly whether the transducer *graph* is functional, i.e.
+    maps every input to at most one output. Return None if it is, or an
+    ``(input, output1, output2)`` triple of strings with two different
+    outputs for the same input if it is not.
+
+    This is the squaring test of Beal, Carton, Prieur and Sakarovitch (also
+    used by Allauzen and Mohri): pair up paths that read the same input, keep
+    only pairs of states from which both paths can still succeed, and track
+    the delay between the two outputs. The transducer is functional iff each
+    such pair is reached with a single delay and every final pair with an
+    empty one. Runs in time polynomial in the size of the machine. """
+    if graph.start is None:
+        return None
+    origin = (graph.start, graph.start)
+
+    # Forward pass: every reachable pair, with reverse edges for the
+    # backward pass.
+    predecessors = {origin: []}
+    queue = deque([origin])
+    while queue:
+        pair = queue.popleft()
+        for edge in _squareEdges(graph, pair):
+            nextpair = edge[3]
+            if nextpair not in predecessors:
+                predecessors[nextpair] = []
+                queue.append(nextpair)
+            predecessors[nextpair].append(pair)
+
+    # Backward pass: pairs from which both paths can reach a final state.
+    coaccessible = {pair for pair in predecessors
+                    if pair[0] in graph.finals and pair[1] in graph.finals}
+    queue = deque(coaccessible)
+    while queue:
+        pair = queue.popleft()
+        for previous in predecessors[pair]:
+            if previous not in coaccessible:
+                coaccessible.add(previous)
+                queue.append(previous)
+    if origin not in coaccessible:
+        return None
+
+    # Delay pass over the trimmed square.
+    delays = {origin: ((), ())}
+    parents = {origin: None}
+    queue = deque([origin])
+    while queue:
+        pair = queue.popleft()
+        delay = delays[pair]
+        if pair[0] in graph.finals and pair[1] in graph.finals and delay != ((), ()):
+            return _witness(graph, parents, coaccessible, [], pair)
+        for edge in _squareEdges(graph, pair):
+            ilabel, out1, out2, nextpair = edge
+            if nextpair not in coaccessible:
+                continue
+            newDelay = _appendDelay(delay, out1, out2)
+            if newDelay is None:
+                return _witness(graph, parents, coaccessible,
+                                [(pair, edge)], nextpair)
+            if nextpair not in delays:
+                delays[nextpair] = newDelay
+                parents[nextpair] = (pair, edge)
+                queue.append(nextpair)
+            elif delays[nextpair] != newDelay:
+                return _witness(graph, parents, coaccessible,
+                                [(pair, edge)], nextpair)
+    return None
+
+
+def _treePath(parents, pair):
+    edges = []
+    while parents[pair] is not None:
+        previous, edge = parents[pair]
+        edges.append(edge)
+        pair = previous
+    edges.reverse()
+    return edges
+
+
+def _continuation(graph, coaccessible, pair):
+    """ Shortest sequence of square edges from *pair* to a final pair. """
+    parents = {pair: None}
+    queue = deque([pair])
+    while queue:
+        current = queue.popleft()
+        if current[0] in graph.finals and current[1] in graph.finals:
+            return _treePath(parents, current)
+        for edge in _squareEdges(graph, current):
+            nextpair = edge[3]
+            if nextpair in coaccessible and nextpair not in parents:
+                parents[nextpair] = (current, edge)
+                queue.append(nextpair)
+    raise AssertionError("pair is not coaccessible")
+
+
+def _witness(graph, parents, coaccessible, lastEdges, pair):
+    """ Build a witness from the paths reaching *pair*: the tree path, and
+    (if given) the tree path to the source of *lastEdges* followed by them.
+    Their delays differ, so at least one of them, continued to a final pair,
+    produces two different outputs. """
+    suffix = _continuation(graph, coaccessible, pair)
+    candidates = [_treePath(parents, pair) if pair in parents else None]
+    for source, edge in lastEdges:
+        candidates.append(_treePath(parents, source) + [edge])
+    for prefix in candidates:
+        if prefix is None:
+            continue
+        edges = prefix + suffix
+        inputs = detokenize(edge[0] for edge in edges)
+        out1 = detokenize(edge[1] for edge in edges)
+        out2 = detokenize(edge[2] for edge in edges)
+        if out1 != out2:
+            return (inputs, out1, out2)
+    raise AssertionError("conflicting delays produced no witness")
+
+
+def tokenize(string):
+    """ Split a serialized string into the labels that spell it in a graph,
+    the way Pynini compiles it: bracketed multi-character tokens stay whole,
+    an escaped bracket or backslash is the character it escapes, and any
+    other backslash stands for itself. """
+    return [token for token, _, _ in tokenSpans(string)]
+
+
+def tokenSpans(string):
+    """ Like :func:`tokenize`, but return ``(token, start, end)`` triples
+    giving the slice of *string* that spells each token. """
+    spans = []
+    i = 0
+    while i < len(string):
+        char = string[i]
+        if char == "\\" and string[i+1:i+2] in ("[", "]", "\\"):
+            spans.append((string[i+1], i, i + 2))
+            i += 2
+        elif char == "[" and "]" in string[i:]:
+            end = string.index("]", i) + 1
+            token = string[i+1:end-1]
+            spans.append((token if len(token) == 1 else string[i:end], i, end))
+            i = end
+        else:
+            spans.append((char, i, i + 1))
+            i += 1
+    return spans
+
+
+_ESCAPES = {"[": "\\[", "]": "\\]"}
+
+
+def detokenize(labels):
+    """ The inverse of :func:`tokenize`: spell *labels* as a serialized
+    string. Brackets are escaped, and so are backslashes, but only where one
+    would otherwise be read as an escape. Epsilons are skipped. """
+    labels = [label for label in labels if label]
+    pieces = []
+    for label, following in zip(labels, labels[1:] + [""]):
+        if label == "\\" and following[:1] in ("[", "]", "\\"):
+            pieces.append("\\\\")
+        else:
+            pieces.append(_ESCAPES.get(label, label))
+    return "".join(pieces)
+
+
+def canonical(string):
+    """ Return the spelling of *string* that :func:`detokenize` gives its
+    labels, which is the same for any two strings that Pynini compiles to
+    the same labels. """
+    if "[" not in string and "\\" not in string:
+        return string
+    return detokenize(tokenize(string))
+
+
+def concatenate(first, second):
+    """ Return a serialized string spelling the labels of *first* followed
+    by those of *second*. Joining the strings only goes wrong if *first*
+    ends with a backslash, which *second* could turn into an escape. """
+    if not first.endswith("\\"):
+        return first + second
+    return detokenize(tokenize(first) + tokenize(second))
+
+
+def splitPrefix(string):
+    """ Split *string*, the start of a serialized string, into the part that
+    spells whole tokens and the start of the token it ends in, if any: an
+    unclosed bracketed token, or a backslash that may be escaping the
+    character after it. """
+    spans = tokenSpans(string)
+    for _, start, end in spans:
+        if string[start] == "[" and end - start == 1:
+            return string[:start], string[start:]
+    if spans and string.endswith("\\") and spans[-1][1] == len(string) - 1:
+        return string[:-1], "\\"
+    return string, ""
+
+
+def prefixStates(graph, tokens, partial="", side=0):
+    """ Return ``(state, labels)`` pairs for the states reached by reading
+    *tokens* on *side*, and then, if *partial* is given (see
+    :func:`splitPrefix`), one label that it is the start of. *labels* are
+    the labels read to reach each state. """
+    states = walk(graph, tokens, side)
+    tokens = tuple(tokens)
+    if not partial:
+        return [(state, tokens) for state in states]
+    if partial == "\\":
+        matches = lambda label: label in ("\\", "[", "]")
+    else:
+        matches = lambda label: len(label) > 1 and label.startswith(partial)
+    labels = {arc[side] for state in states for arc in graph.arcs[state]
+              if matches(arc[side])}
+    return [(state, tokens + (label,)) for label in sorted(labels)
+            for state in _closure(graph, _step(graph, states, label, side),
+                                  side)]
+
+
+def _closure(graph, states, side):
+    """ Add to *states* every state reachable from them by arcs with an
+    epsilon label on *side* (0 for input, 1 for output). """
+    stack = list(states)
+    seen = set(states)
+    while stack:
+        state = stack.pop()
+        for arc in graph.arcs[state]:
+            if arc[side] == "" and arc[3] not in seen:
+                seen.add(arc[3])
+                stack.append(arc[3])
+    return seen
+
+
+def _step(graph, states, token, side):
+    if side == 0:
+        return {arc[3] for state in states
+                for arc in graph.arcsByInput(state).get(token, ())}
+    return {arc[3] for state in states
+            for arc in graph.arcs[state] if arc[1] == token}
+
+
+def walk(graph, tokens, side=0):
+    """ Return the set of states reached by reading *tokens* on *side* (0
+    for input, 1 for output) from the start state, following epsilon arcs. """
+    if graph.start is None:
+        return set()
+    states = _closure(graph, {graph.start}, side)
+    for token in tokens:
+        if not states:
+            break
+        states = _closure(graph, _step(graph, states, token, side), side)
+    return states
+
+
+def accepts(graph, tokens, side=0):
+    """ Return True if *graph* accepts *tokens* on *side*. """
+    return any(state in graph.finals for state in walk(graph, tokens, side))
+
+
+def transduce(graph, tokens):
+    """ Return one output string for the input *tokens*, or None if they are
+    not accepted. Searches breadth-first over (state, position) pairs,
+    visiting each pair once, so epsilon cycles cannot trap it. """
+    if graph.start is None:
+        return None
+    origin = (graph.start, 0)
+    parents = {origin: None}
+    queue = deque([origin])
+    while queue:
+        config = queue.popleft()
+        state, position = config
+        if position == len(tokens) and state in graph.finals:
+            output = []
+            while parents[config] is not None:
+                config, olabel = parents[config]
+                output.append(olabel)
+            output.reverse()
+            return detokenize(output)
+        arcs = list(graph.arcsByInput(state).get("", ()))
+        if position < len(tokens):
+            arcs += graph.arcsByInput(state).get(tokens[position], ())
+        for ilabel, olabel, _, nextstate in arcs:
+            nextconfig = (nextstate, position + (ilabel != ""))
+            if nextconfig not in parents:
+                parents[nextconfig] = (config, olabel)
+                queue.append(nextconfig)
+    return None
+
+
+def fuzzyMatches(graph, tokens, maxDistance, side=0):
+    """ Return ``(string, distance)`` pairs for every string spelled on *side*
+    by a successful path through *graph* whose Levenshtein distance from
+    *tokens* is at most *maxDistance*, closest first, then alphabetically.
+
+    Searches depth-first, carrying one row of the edit-distance table along
+    each path prefix and abandoning a prefix as soon as every entry in its
+    row exceeds *maxDistance* (Oflazer's error-tolerant recognition), so only
+    the part of the graph near *tokens* is visited. *graph* must have no
+    epsilon cycles. """
+    if graph.start is None:
+        return []
+    matches = {}
+    stack = [(graph.start, (), list(range(len(tokens) + 1)))]
+    while stack:
+        state, labels, row = stack.pop()
+        if state in graph.finals and row[-1] <= maxDistance:
+            string = detokenize(labels)
+            if row[-1] < matches.get(string, maxDistance + 1):
+                matches[string] = row[-1]
+        for arc in graph.arcs[state]:
+            label = arc[side]
+            if label == "":
+                nextRow = row
+            else:
+                nextRow = [row[0] + 1]
+                for i, token in enumerate(tokens, 1):
+                    nextRow.append(min(nextRow[i-1] + 1, row[i] + 1,
+                                       row[i-1] + (token != label)))
+                if min(nextRow) > maxDistance:
+                    continue
+            stack.append((arc[3], labels + (label,), nextRow))
+    return sorted(matches.items(), key=lambda match: (match[1], match[0]))
+
+
+def completions(graph, starts, side=0):
+    """ Yield the strings spelled on *side* by paths from *starts*, a list of
+    ``(state, labels)`` pairs as returned by :func:`prefixStates`, to a final
+    state, each spelled after the *labels* that reached its state:
+    breadth-first, so shortest first, and in label order among strings of
+    the same length. Lazy, and never enters a branch that cannot reach a
+    final state, so it is safe on cyclic graphs. """
+    live = graph.finalDistances()
+    queue = deque(sorted((labels, state) for state, labels in starts
+                         if state in live))
+    while queue:
+        labels, state = queue.popleft()
+        if state in graph.finals:
+            yield detokenize(labels)
+        for arc in sorted(graph.arcs[state], key=lambda arc: arc[side]):
+            if arc[3] in live:
+                queue.append((labels + (arc[side],), arc[3]))
+
+
+def rankedCompletions(graph, starts, side=0):
+    """ Yield ``(string, weight)`` for the strings spelled on *side* by paths
+    from *starts* (as for :func:`completions`) to a final state, lowest
+    weight first. This is an A* search whose heuristic, the exact distance
+    from each state to a final state, is computed once per graph, so every
+    string is found without expanding a single state off its best path. """
+    distances = graph.finalDistances()
+    # Entries are (estimate, labels, done, weight, state); finished strings
+    # sort before states with the same estimate and labels.
+    heap = [(distances[state], labels, 1, 0.0, state)
+            for state, labels in starts if state in distances]
+    heapq.heapify(heap)
+    while heap:
+        estimate, labels, pending, weight, state = heapq.heappop(heap)
+        if not pending:
+            yield detokenize(labels), weight
+            continue
+        if state in graph.finals:
+            total = weight + graph.finals[state]
+            heapq.heappush(heap, (total, labels, 0, total, state))
+        for arc in graph.arcs[state]:
+            if arc[3] in distances:
+                nextWeight = weight + arc[2]
+                heapq.heappush(heap, (nextWeight + distances[arc[3]],
+                                      labels + (arc[side],), 1, nextWeight,
+                                      arc[3]))
+
+
+def _pathCounts(graph):
+    """ Return a list giving, for each state reachable from the start, the
+    number of paths from it to a final state (None for other states). Raises
+    ValueError if a cycle is reachable, since the counts would be infinite.
+    """
+    counts = [None] * graph.numStates
+    if graph.start is None:
+        return counts
+    onStack = set()
+    stack = [(graph.start, iter(graph.arcs[graph.start]))]
+    onStack.add(graph.start)
+    while stack:
+        state, arcs = stack[-1]
+        for arc in arcs:
+            nextstate = arc[3]
+            if nextstate in onStack:
+                raise ValueError("Can't number the paths of a cyclic machine")
+            if counts[nextstate] is None:
+                onStack.add(nextstate)
+                stack.append((nextstate, iter(graph.arcs[nextstate])))
+                break
+        else:
+            stack.pop()
+            onStack.discard(state)
+            counts[state] = (int(state in graph.finals) +
+                             sum(counts[arc[3]] for arc in graph.arcs[state]))
+    return counts
+
+
+def _buildRankTable(graph):
+    """ For each state, list its arcs in label order as ``(labels, offsets,
+    nextstates, positions)``: the offset of an arc is the number of strings
+    from that state that sort before the ones through it (the state's own
+    empty string first, if it is final), and *positions* maps each label to
+    its place in the lists. """
+    counts = _pathCounts(graph)
+    table = [None] * graph.numStates
+    for state, stateArcs in enumerate(graph.arcs):
+        if counts[state] is None:
+            continue
+        offset = int(state in graph.finals)
+        labels, offsets, nextstates = [], [], []
+        for arc in sorted(stateArcs, key=lambda arc: arc[0]):
+            labels.append(arc[0])
+            offsets.append(offset)
+            nextstates.append(arc[3])
+            offset += counts[arc[3]]
+        positions = {label: i for i, label in enumerate(labels)}
+        table[state] = (labels, offsets, nextstates, positions)
+    return counts, table
+
+
+def indexOf(graph, tokens):
+    """ Return the position of *tokens* among the strings accepted by the
+    deterministic, acyclic *graph*, in label order: a minimal perfect hash,
+    computed in one step per token. Raises KeyError if *tokens* is not
+    accepted. """
+    counts, table = graph.rankTable()
+    state = graph.start
+    if state is None:
+        raise KeyError(tokens)
+    index = 0
+    for token in tokens:
+        labels, offsets, nextstates, positions = table[state]
+        try:
+            i = positions[token]
+        except KeyError:
+            raise KeyError(tokens) from None
+        index += offsets[i]
+        state = nextstates[i]
+    if state not in graph.finals:
+        raise KeyError(tokens)
+    return index
+
+
+def stringAt(graph, index):
+    """ Inverse of :func:`indexOf`: return the labels of the string at
+    position *index*, counting from the end if it is negative. Raises
+    IndexError if there is no such string. """
+    counts, table = graph.rankTable()
+    state = graph.start
+    if state is None or not -counts[state] <= index < counts[state]:
+        raise IndexError(index)
+    if index < 0:
+        index += counts[state]
+    labels = []
+    while not (index == 0 and state in graph.finals):
+        stateLabels, offsets, nextstates, _ = table[state]
+        i = bisect_right(offsets, index) - 1
+        index -= offsets[i]
+        labels.append(stateLabels[i])
+        state = nextstates[i]
+    return labels
+
+
+def _spell(parents, config):
+    labels = []
+    while parents[config] is not None:
+        config, label = parents[config]
+        labels.append(label)
+    labels.reverse()
+    return detokenize(labels)
+
+
+def differenceWitness(graph1, graph2, side=0):
+    """ Return a string spelled on *side* by *graph1* but not by
+    *graph2*, or None if there is none. The product of *graph1* with the
+    determinized complement of *graph2* is explored breadth-first, one
+    (state, subset of states) pair at a time, and the search stops at the
+    first witness, so neither machine is determinized or multiplied out in
+    full. """
+    if graph1.start is None:
+        return None
+    live = graph1.finalDistances()
+    if graph1.start not in live:
+        return None
+    empty = frozenset()
+    subset = (empty if graph2.start is None else
+              frozenset(_closure(graph2, {graph2.start}, side)))
+    origin = (graph1.start, subset)
+    parents = {origin: None}
+    queue = deque([origin])
+    while queue:
+        config = queue.popleft()
+        state, subset = config
+        if (state in graph1.finals and
+                not any(other in graph2.finals for other in subset)):
+            return _spell(parents, config)
+        for arc in graph1.arcs[state]:
+            if arc[3] not in live:
+                continue
+            label = arc[side]
+            if label == "":
+                nextconfig = (arc[3], subset)
+            elif subset:
+                nextconfig = (arc[3], frozenset(_closure(
+                        graph2, _step(graph2, subset, label, side), side)))
+            else:
+                nextconfig = (arc[3], empty)
+            if nextconfig not in parents:
+                parents[nextconfig] = (config, label)
+                queue.append(nextconfig)
+    return None
+
+
+def intersectionWitness(graph1, graph2, side=0):
+    """ Return a string spelled on *side* by both graphs, or None
+    if there is none, exploring pairs of states breadth-first and stopping
+    at the first witness. """
+    if graph1.start is None or graph2.start is None:
+        return None
+    live1, live2 = graph1.finalDistances(), graph2.finalDistances()
+    origin = (graph1.start, graph2.start)
+    if graph1.start not in live1 or graph2.start not in live2:
+        return None
+    parents = {origin: None}
+    queue = deque([origin])
+    while queue:
+        config = queue.popleft()
+        p, q = config
+        if p in graph1.finals and q in graph2.finals:
+            return _spell(parents, config)
+        moves = []
+        for arc in graph1.arcs[p]:
+            label = arc[side]
+            if label == "":
+                moves.append(("", arc[3], q))
+            elif side == 0:
+                moves.extend((label, arc[3], arc2[3]) for arc2 in
+                             graph2.arcsByInput(q).get(label, ()))
+            else:
+                moves.extend((label, arc[3], arc2[3])
+                             for arc2 in graph2.arcs[q] if arc2[1] == label)
+        moves.extend(("", p, arc2[3]) for arc2 in graph2.arcs[q]
+                     if arc2[side] == "")
+        for label, p2, q2 in moves:
+            nextconfig = (p2, q2)
+            if (p2 in live1 and q2 in live2 and
+                    nextconfig not in parents):
+                parents[nextconfig] = (config, label)
+                queue.append(nextconfig)
+    return None
+
+
+def _pick(rng, arcs, cumulative, total):
+    """ Choose one of *arcs*, the i-th with probability proportional to
+    ``cumulative[i] - cumulative[i - 1]``, or None, with the remaining
+    probability up to *total*, for stopping. """
+    r = rng.randrange(total)
+    if not arcs or r >= cumulative[-1]:
+        return None
+    return arcs[bisect_right(cumulative, r)]
+
+
+def samplePaths(graph, k, rng, maxLength=None):
+    """ Draw *k* successful paths uniformly at random, with replacement, and
+    return them as ``(input, output)`` string pairs. Paths are chosen one arc
+    at a time, each with probability proportional to the number of paths it
+    leads to, so nothing is enumerated: without *maxLength* the counts are
+    the ones :func:`indexOf` uses, which exist only for acyclic graphs; with
+    it, paths of at most *maxLength* arcs are counted by length, and drawn
+    uniformly from among those. Raises ValueError if there are no paths to
+    draw. In a deterministic graph every path spells a different string, so
+    this draws strings uniformly. """
+    if maxLength is None:
+        counts = graph.rankTable()[0]
+        def count(state, remaining):
+            return counts[state]
+    else:
+        # bounded[n][state] counts the paths of at most n arcs from state.
+        bounded = [[int(state in graph.finals)
+                    for state in range(graph.numStates)]]
+        for _ in range(maxLength):
+            previous = bounded[-1]
+            bounded.append([int(state in graph.finals) +
+                            sum(previous[arc[3]] for arc in stateArcs)
+                            for state, stateArcs in enumerate(graph.arcs)])
+        def count(state, remaining):
+            return bounded[remaining][state]
+    if graph.start is None or not count(graph.start, maxLength):
+        raise ValueError("Can't sample from a machine with no paths")
+    choices = {}
+    samples = []
+    for _ in range(k):
+        state, remaining = graph.start, maxLength
+        inputs, outputs = [], []
+        while True:
+            key = (state, remaining)
+            if key not in choices:
+                arcs = graph.arcs[state] if remaining != 0 else []
+                weights = [count(arc[3], None if remaining is None
+                                 else remaining - 1) for arc in arcs]
+                choices[key] = (arcs, list(accumulate(weights)),
+                                count(state, remaining))
+            arc = _pick(rng, *choices[key])
+            if arc is None:
+                break
+            inputs.append(arc[0])
+            outputs.append(arc[1])
+            state = arc[3]
+            if remaining is not None:
+                remaining -= 1
+        samples.append((detokenize(inputs), detokenize(outputs)))
+    return samples
+
+
+class MatchScanner(object):
+    """ Finds the substrings of a stream of tokens that *graph* spells on
+    *side*, in one pass. Every position of the stream starts a thread in the
+    graph's start state; threads in the same state are advanced together,
+    keeping the set of positions they started from, and die as soon as they
+    reach a state from which no final state can be reached. This simulates
+    Sigma* followed by the graph, as an Aho-Corasick automaton does for a
+    list of keywords, without building that product.
+
+    Feed tokens with :meth:`feed` and end the input with :meth:`close`. Both
+    return the ``(start, end)`` token spans that have been settled, in order.
+    Empty matches are never reported. With *overlapping*, every start
+    position gets its longest match (or, without *longest*, every match);
+    otherwise matches are chosen leftmost first and do not overlap, each the
+    longest (or shortest) one at its start. """
+
+    def __init__(self, graph, overlapping=False, longest=True, side=0):
+        self.graph = graph
+        self.overlapping = overlapping
+        self.longest = longest
+        self.side = side
+        self.live = graph.finalDistances()
+        self.origin = ([] if graph.start is None else
+                       [state for state in _closure(graph, {graph.start}, side)
+                        if state in self.live])
+        self.position = 0
+        self.active = {}
+        self.best = {}
+        self.found = []
+        self.lastEnd = 0
+        self._moves = {}
+
+    def _nextStates(self, state, token):
+        try:
+            return self._moves[state, token]
+        except KeyError:
+            states = [nextstate for nextstate in _closure(
+                    self.graph, _step(self.graph, {state}, token, self.side),
+                    self.side) if nextstate in self.live]
+            self._moves[state, token] = states
+            return states
+
+    def horizon(self):
+        """ The earliest position that a match not yet returned can start
+        at. """
+        starts = [min(starts) for starts in self.active.values()]
+        starts.extend(self.best)
+        starts.extend(start for start, _ in self.found)
+        return min(starts, default=self.position)
+
+    def feed(self, tokens):
+        settled = []
+        for token in tokens:
+            if self.overlapping or self.position >= self.lastEnd:
+                for state in self.origin:
+                    self.active.setdefault(state, set()).add(self.position)
+            active = {}
+            for state, starts in self.active.items():
+                for nextstate in self._nextStates(state, token):
+                    active.setdefault(nextstate, set()).update(starts)
+            self.active = active
+            self.position += 1
+            self._record()
+            settled.extend(self._settle(min(
+                    (min(starts) for starts in self.active.values()),
+                    default=self.position)))
+        return settled
+
+    def close(self):
+        self.active = {}
+        return self._settle(float("inf"))
+
+    def _record(self):
+        matched = set()
+        for state, starts in self.active.items():
+            if state in self.graph.finals:
+                matched.update(starts)
+        if not matched:
+            return
+        for start in matched:
+            if self.overlapping and not self.longest:
+                heapq.heappush(self.found, (start, self.position))
+            elif self.longest or start not in self.best:
+                self.best[start] = self.position
+        if not self.longest and not self.overlapping:
+            # The shortest match at each of these starts has been found.
+            for starts in self.active.values():
+                starts -= matched
+            self.active = {state: starts for state, starts
+                           in self.active.items() if starts}
+
+    def _settle(self, frontier):
+        """ Return the matches starting before *frontier*, the earliest
+        position any live thread started at, which nothing can change. """
+        settled = []
+        while self.found and self.found[0][0] < frontier:
+            settled.append(heapq.heappop(self.found))
+        for start in sorted(start for start in self.best if start < frontier):
+            end = self.best.pop(start)
+            if self.overlapping:
+                settled.append((start, end))
+            elif start >= self.lastEnd:
+                settled.append((start, end))
+                self.lastEnd = end
+        if not self.overlapping and settled:
+            # Threads inside the last match can no longer produce one.
+            for starts in self.active.values():
+                starts -= {start for start in starts if start < self.lastEnd}
+            self.active = {state: starts for state, starts
+                           in self.active.items() if starts}
+        return settled
+
+
+def _inputClosure(graph, configs, live):
+    """ Extend *configs*, a dict mapping ``(state, pending output labels)``
+    to the best weight reaching it, along arcs with an epsilon input. A path
+    without a cycle has fewer arcs than the graph has states, so paths are
+    followed no further than that, and output-producing epsilon cycles
+    cannot make the closure infinite. """
+    stack = [(config, 0) for config in configs]
+    while stack:
+        (state, pending), depth = stack.pop()
+        if depth >= graph.numStates:
+            continue
+        weight = configs[state, pending]
+        for _, olabel, arcWeight, nextstate in graph.arcsByInput(state).get(
+                "", ()):
+            if nextstate not in live:
+                continue
+            config = (nextstate, pending + (olabel,) if olabel else pending)
+            if weight + arcWeight < configs.get(config, float("inf")):
+                configs[config] = weight + arcWeight
+                stack.append((config, depth + 1))
+    return configs
+
+
+def transduceStream(graph, batches):
+    """ Run *graph* as a transducer over a stream of input tokens, given as
+    an iterable of token lists, and yield its output as it becomes certain.
+    All the ways of reading the input so far are followed at once, each as
+    a state with the output not yet emitted; whatever output they agree on
+    is yielded and dropped. So memory is bounded by how far the machine has
+    to read ahead before it commits to an output, which for a rewrite rule
+    is the length of its right context, not by the length of the stream.
+    At the end, the rest of the best successful path's output is yielded.
+    Raises ValueError, after yielding the output up to that point, if the
+    input is not accepted.
+
+    Output is spelled with :func:`detokenize`. How a backslash is spelled
+    depends on the label after it, so a trailing backslash is held back
+    until that label is known. """
+    live = graph.finalDistances()
+    if graph.start not in live:
+        raise ValueError("The machine accepts no input")
+    configs = _inputClosure(graph, {(graph.start, ()): 0.0}, live)
+    held = ()
+    position = 0
+    for batch in batches:
+        for token in batch:
+            nextConfigs = {}
+            for (state, pending), weight in configs.items():
+                for _, olabel, arcWeight, nextstate in graph.arcsByInput(
+                        state).get(token, ()):
+                    if nextstate not in live:
+                        continue
+                    config = (nextstate,
+                              pending + (olabel,) if olabel else pending)
+                    if weight + arcWeight < nextConfigs.get(config,
+                                                            float("inf")):
+                        nextConfigs[config] = weight + arcWeight
+            position += 1
+            if not nextConfigs:
+                raise ValueError("No path reads token %d of the input, %r"
+                                 % (position - 1, token))
+            configs = _inputClosure(graph, nextConfigs, live)
+            common = commonprefix([pending for _, pending in configs])
+            if common:
+                configs = {(state, pending[len(common):]): weight
+                           for (state, pending), weight in configs.items()}
+                labels = held + common
+                text = detokenize(labels)
+                held = labels[-1:] if labels[-1] == "\\" else ()
+                if held:
+                    text = text[:-1]
+                if text:
+                    yield text
+    endings = [(weight + graph.finals[state], pending)
+               for (state, pending), weight in configs.items()
+               if state in graph.finals]
+    if not endings:
+        raise ValueError("The input ends before the machine can accept it")
+    rest = detokenize(held + min(endings)[1])
+    if rest:
+        yield rest
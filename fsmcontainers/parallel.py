@@ -0,0 +1,76 @@
+""" Building independent parts of a grammar in parallel. """
+
+import concurrent.futures
+import operator
+import os
+from . import settings
+
+
+def balancedReduce(op, items):
+    """ Combine *items* with the binary *op* in a balanced tree rather than
+    a left fold, so that each item takes part in about log2(n) operations
+    instead of up to n. For union, where the cost of each operation grows
+    with the size of its operands, this turns quadratic work into
+    n log n. """
+    items = list(items)
+    if not items:
+        raise ValueError("nothing to combine")
+    while len(items) > 1:
+        merged = [op(items[i], items[i + 1])
+                  for i in range(0, len(items) - 1, 2)]
+        if len(items) % 2:
+            merged.append(items[-1])
+        items = merged
+    return items[0]
+
+
+def _call(fn, args, level, limits):
+    # Workers are separate processes, so the caller's optimization level and
+    # resource limits are passed along explicitly.
+    token = settings._limits.set(limits)
+    try:
+        with settings.optimization_level(level):
+            return fn(*args)
+    finally:
+        settings._limits.reset(token)
+
+
+def compile_parallel(fn, args, workers=None, op=operator.or_, combine=True):
+    """
+    Call ``fn(arg)`` for each of *args* in a pool of *workers* processes
+    (by default, one per core) and combine the containers it returns with
+    *op*, by default union, in a balanced tree whose levels are also
+    computed in the pool. Containers travel between processes pickled, so
+    compiled machines are sent in OpenFst's binary format. With
+    *combine* false, return the list of results instead.
+
+    *fn* and *op* must be picklable, which in practice means defined at the
+    top level of a module. The caller's optimization level and resource
+    limits apply in the workers.
+
+        >>> def suffixed(s):  # doctest: +SKIP
+        ...     return fst({"": s}) + fst(character.star())
+        >>> grammar = compile_parallel(suffixed, ["-ay", "-way"])  # doctest: +SKIP
+    """
+    args = [(arg,) for arg in args]
+    workers = workers or os.cpu_count() or 1
+    level = settings.get_optimization_level()
+    limits = settings.get_resource_limits()
+
+    def run(pool, fn, calls, chunksize=1):
+        n = len(calls)
+        return list(pool.map(_call, [fn] * n, calls, [level] * n,
+                             [limits] * n, chunksize=chunksize))
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = run(pool, fn, args, max(1, len(args) // (4 * workers)))
+        if not combine:
+            return results
+        if not results:
+            raise ValueError("compile_parallel needs at least one argument")
+        while len(results) > 1:
+            merged = run(pool, op, list(zip(results[0::2], results[1::2])))
+            if len(results) % 2:
+                merged.append(results[-1])
+            results = merged
+    return results[0]
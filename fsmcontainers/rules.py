@@ -0,0 +1,162 @@
+""" Compiling and applying ordered sets of context-dependent rewrite rules. """
+
+import operator
+import pickle
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+from .caching import LookupCache
+from .fsmcontainers import fsmcontainer, fsa, fst, SIGMA, _sigmaStar
+from .parallel import compile_parallel, balancedReduce
+from .settings import get_optimization_level
+
+
+class Rule(namedtuple("Rule", ["change", "left", "right"])):
+    """ A rewrite rule: rewrite as *change* (anything :class:`fst` accepts)
+    maps, between the *left* and *right* contexts (anything :class:`fsa`
+    accepts). """
+
+    def __new__(cls, change, left="", right=""):
+        return super().__new__(cls, change, left, right)
+
+
+RuleStats = namedtuple("RuleStats", ["rule", "seconds", "states", "arcs",
+                                     "cached"])
+RuleStats.__doc__ = """ How one rule of a :class:`RuleSet` was compiled:
+the time taken (0 if the machine came from the cache), and the size of the
+compiled machine. """
+
+# Compiled rules, shared by every RuleSet in the process.
+ruleCache = LookupCache(maxsize=1024)
+
+
+def _contentKey(obj):
+    """ A hashable key that is equal for rule parts with equal contents. """
+    if isinstance(obj, fsmcontainer):
+        if obj.fsm.engine == "set":
+            return ("set", tuple(sorted(obj.fsm.pairs)))
+        return (obj.fsm.engine, pickle.dumps(obj.fsm))
+    if isinstance(obj, Mapping):
+        return ("mapping", tuple(sorted(obj.items())))
+    if isinstance(obj, str):
+        return ("string", obj)
+    return ("items", tuple(sorted(obj)))
+
+
+def _symbols(container):
+    return {symbol for symbol in container.fsm.sigma().pathIterator(
+            side="top") if symbol}
+
+
+def _notCached():
+    raise KeyError
+
+
+def _compileRule(job):
+    """ Compile one rule against *sigmaStar*. Runs in worker processes. """
+    rule, sigmaStar = job
+    started = time.perf_counter()
+    change, left, right = fst(rule.change), fsa(rule.left), fsa(rule.right)
+    change._typecheck(left, right)
+    machine = fst.fromAttributes(
+            fsm=change.fsm.makeRewrite(left.fsm, right.fsm,
+                                       sigma=sigmaStar.fsm),
+            keySerializer=change.keySerializer,
+            valueSerializer=change.valueSerializer)
+    return machine, time.perf_counter() - started
+
+
+class RuleSet(object):
+    """
+    An ordered list of rewrite rules, compiled together. The alphabet, and
+    the Sigma* that every rule is compiled against, are computed once for
+    the whole set: by default, :data:`SIGMA` together with every symbol the
+    rules mention. Compiled rules are cached across rule sets, keyed by the
+    rule and the alphabet, so a grammar that is edited and recompiled only
+    compiles the rules that changed. Those are compiled in a pool of
+    *workers* processes (see :func:`compile_parallel`), or in this process
+    if *workers* is 1 or there is only one of them.
+
+    Rules are :class:`Rule` instances or *(change, left, right)* tuples.
+
+      >>> rules = RuleSet([({'a': 'b'}, 'c', ''), ({'b': 'd'}, '', 'd')],
+      ...                 workers=1)
+      >>> rules.apply('cab')
+      'cbb'
+      >>> rules.cascade()['cabd']
+      'cbdd'
+
+    :attr:`stats` lists a :class:`RuleStats` for each rule, in order.
+    """
+
+    def __init__(self, rules, alphabet=None, workers=None):
+        self.rules = [rule if isinstance(rule, Rule) else Rule(*rule)
+                      for rule in rules]
+        if alphabet is None:
+            alphabet = set(SIGMA)
+            for change, left, right in self.rules:
+                alphabet |= _symbols(fst(change))
+                alphabet |= _symbols(fsa(left)) | _symbols(fsa(right))
+        self.alphabet = sorted(alphabet)
+        self.sigmaStar = _sigmaStar(tuple(self.alphabet))
+        self.workers = workers
+        self.machines, self.stats = self._compile()
+
+    def _key(self, rule):
+        return (tuple(_contentKey(part) for part in rule),
+                tuple(self.alphabet), get_optimization_level())
+
+    def _compile(self):
+        machines = [None] * len(self.rules)
+        stats = [None] * len(self.rules)
+        missing = []
+        for i, rule in enumerate(self.rules):
+            try:
+                machine = ruleCache.get(self._key(rule), _notCached)
+            except KeyError:
+                missing.append(i)
+                continue
+            machines[i] = machine
+            stats[i] = RuleStats(rule, 0.0, machine.fsm.numStates(),
+                                 machine.fsm.numArcs(), True)
+        jobs = [(self.rules[i], self.sigmaStar) for i in missing]
+        if len(jobs) > 1 and self.workers != 1:
+            results = compile_parallel(_compileRule, jobs,
+                                       workers=self.workers, combine=False)
+        else:
+            results = [_compileRule(job) for job in jobs]
+        for i, (machine, seconds) in zip(missing, results):
+            rule = self.rules[i]
+            ruleCache.get(self._key(rule), lambda: machine)
+            machines[i] = machine
+            stats[i] = RuleStats(rule, seconds, machine.fsm.numStates(),
+                                 machine.fsm.numArcs(), False)
+        return machines, stats
+
+    def __len__(self):
+        return len(self.machines)
+
+    def __iter__(self):
+        return iter(self.machines)
+
+    def cascade(self):
+        """ Return a single :class:`fst` applying every rule in turn: the
+        composition of the compiled rules, built in a balanced tree. Fast to
+        apply, but can be much larger than the rules together. """
+        return balancedReduce(operator.matmul, self.machines)
+
+    def apply(self, string):
+        """ Apply the rules to *string* one after another, without composing
+        them. """
+        for machine in self.machines:
+            string = machine[string]
+        return string
+
+    def rewrite_text(self, stream):
+        """ Apply the rules to a long text, given as a string or an iterable
+        of chunks, yielding output as it is produced. The rules are chained
+        through :meth:`fst.rewrite_text`, so each one streams into the next
+        and the text is never held in full. """
+        for machine in self.machines:
+            stream = machine.rewrite_text(stream)
+        return stream
@@ -1,4 +1,5 @@
 import six
+import threading
 
 class Serializer(object):
     """ This class does two jobs: It is a lightweight base class for
@@ -15,6 +16,9 @@ class Serializer(object):
     belong to the class TupleSerializer.)"""
 
     serializers = {}
+    _lock = threading.RLock()
+        # Reentrant, because creating a TupleSerializer registers the
+        # serializers for its items.
 
     def __init__(self, prototype):
         pass
@@ -25,25 +29,36 @@ class Serializer(object):
     def inflate(self, string):
         return NotImplemented
 
+    def __reduce__(self):
+        # Unpickle through from_prototype, so that unpickled containers share
+        # the registered serializer and still pass the identity checks done
+        # by binary operations.
+        return (Serializer.from_prototype, (self.prototype,))
+
     @classmethod
     def from_prototype(cls, obj):
         if isinstance(obj, (six.text_type, six.binary_type)):
             key = type(obj)
         else:
             key = (type(obj), len(obj))
-        if key not in cls.serializers:
-            if isinstance(obj, (six.text_type, six.binary_type)):
-                cls.serializers[key] = StringSerializer(obj)
-            elif type(obj) == tuple:
-                cls.serializers[key] = TupleSerializer(obj)
-            else:
-                raise TypeError
-        return cls.serializers[key]
+        try:
+            return cls.serializers[key]
+        except KeyError:
+            pass
+        with cls._lock:
+            if key not in cls.serializers:
+                if isinstance(obj, (six.text_type, six.binary_type)):
+                    cls.serializers[key] = StringSerializer(obj)
+                elif type(obj) == tuple:
+                    cls.serializers[key] = TupleSerializer(obj)
+                else:
+                    raise TypeError
+            return cls.serializers[key]
 
 class StringSerializer(Serializer):
 
     def __init__(self, prototype):
-        pass
+        self.prototype = type(prototype)()
 
     def serialize(self, obj):
         if not isinstance(obj, six.string_types):
@@ -67,6 +82,7 @@ class TupleSerializer(Serializer):
     def __init__(self, prototype):
         self.length = len(prototype)
         self.itemserializers = tuple(Serializer.from_prototype(x) for x in prototype)
+        self.prototype = tuple(s.prototype for s in self.itemserializers)
 
     def serialize(self, obj):
         if len(obj) != self.length:
@@ -93,8 +109,13 @@ def take_n_by_n(t, n):
 
 def braces_balanced(string):
     brace = False
+    escaped = False
     for c in string:
-        if c == '[':
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '[':
             if brace:
                 return False
             else:
@@ -0,0 +1,181 @@
+""" Settings that control how wrapped FSMs are built.
+
+The ``set_*`` functions change process-wide defaults. The context managers
+override them only for the current thread (or asyncio task), so one
+thread's limits or optimization level never leak into another's. """
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+class ResourceLimitError(RuntimeError):
+    """ Raised when an FSM operation would exceed, or has exceeded, one of the
+    configured resource limits. """
+
+
+class ResourceLimits(object):
+    """ Limits on the size of machines and on the time spent building them.
+    Any limit that is None is not enforced.
+
+    *max_states* and *max_arcs* bound the size of every machine produced by a
+    wrapper operation. *max_estimated_states* bounds the estimated size of a
+    result before the operation is run, so that an obviously hopeless
+    composition fails immediately instead of after it has eaten all available
+    memory. *max_seconds* bounds the total time spent inside the
+    :func:`resource_limits` block that set it. """
+
+    def __init__(self, max_states=None, max_arcs=None,
+                 max_estimated_states=None, max_seconds=None):
+        self.max_states = max_states
+        self.max_arcs = max_arcs
+        self.max_estimated_states = max_estimated_states
+        self.max_seconds = max_seconds
+        self.deadline = (None if max_seconds is None
+                         else time.monotonic() + max_seconds)
+
+    def replace(self, **kwargs):
+        """ Return a copy of these limits with some values replaced. A new
+        *max_seconds* starts a new deadline; otherwise the old one is kept. """
+        values = dict(max_states=self.max_states,
+                      max_arcs=self.max_arcs,
+                      max_estimated_states=self.max_estimated_states,
+                      max_seconds=self.max_seconds)
+        values.update(kwargs)
+        obj = type(self)(**values)
+        if "max_seconds" not in kwargs:
+            obj.deadline = self.deadline
+        return obj
+
+    def checkDeadline(self, opname):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ResourceLimitError(
+                "%s: time limit of %ss exceeded" % (opname, self.max_seconds))
+
+    def checkEstimate(self, opname, estimate):
+        if (self.max_estimated_states is not None and
+                estimate > self.max_estimated_states):
+            raise ResourceLimitError(
+                "%s: result is estimated to have up to %d states, more than "
+                "the limit of %d" % (opname, estimate,
+                                     self.max_estimated_states))
+
+    def checkSize(self, opname, numStates, countArcs):
+        """ Check the size of a finished machine. *countArcs* is a callable,
+        since counting arcs means visiting every state and is only worth doing
+        when an arc limit is set. """
+        if self.max_states is not None and numStates > self.max_states:
+            raise ResourceLimitError(
+                "%s: result has %d states, more than the limit of %d"
+                % (opname, numStates, self.max_states))
+        if self.max_arcs is not None:
+            numArcs = countArcs()
+            if numArcs > self.max_arcs:
+                raise ResourceLimitError(
+                    "%s: result has %d arcs, more than the limit of %d"
+                    % (opname, numArcs, self.max_arcs))
+
+    @property
+    def active(self):
+        return any(x is not None for x in (self.max_states, self.max_arcs,
+                                           self.max_estimated_states,
+                                           self.deadline))
+
+
+_defaultLimits = ResourceLimits()
+_limits = ContextVar("resource_limits", default=None)
+
+
+def get_resource_limits():
+    """ Return the resource limits currently in force. """
+    return _limits.get() or _defaultLimits
+
+
+def set_resource_limits(**kwargs):
+    """ Change the default resource limits for all subsequent operations.
+    Accepts the same keyword arguments as :class:`ResourceLimits`. """
+    global _defaultLimits
+    _defaultLimits = _defaultLimits.replace(**kwargs)
+
+
+@contextmanager
+def resource_limits(**kwargs):
+    """ Apply resource limits for the duration of a ``with`` block in the
+    current thread, restoring the previous limits afterwards.
+
+        >>> with resource_limits(max_states=100000, max_seconds=30):
+        ...     grammar = build_grammar()  # doctest: +SKIP
+    """
+    token = _limits.set(get_resource_limits().replace(**kwargs))
+    try:
+        yield _limits.get()
+    finally:
+        _limits.reset(token)
+
+
+OPTIMIZATION_LEVELS = ("none", "cheap", "full")
+
+_defaultOptimizationLevel = "cheap"
+_optimizationLevel = ContextVar("optimization_level", default=None)
+
+
+def _checkOptimizationLevel(level):
+    if level not in OPTIMIZATION_LEVELS:
+        raise ValueError("Optimization level must be one of %s, not %r"
+                         % (", ".join(OPTIMIZATION_LEVELS), level))
+    return level
+
+
+def get_optimization_level():
+    """ Return the optimization level applied to the result of every
+    constructive operation. """
+    return _optimizationLevel.get() or _defaultOptimizationLevel
+
+
+def set_optimization_level(level):
+    """ Set the default optimization level applied to the result of every
+    constructive operation:
+
+    * ``"none"``: leave results exactly as OpenFst builds them. Fastest to
+      build, but results may be large and full of epsilon arcs.
+    * ``"cheap"`` (the default): remove epsilon arcs and trim states that are
+      not on any successful path.
+    * ``"full"``: also determinize and minimize. Slowest to build, smallest
+      results.
+
+    A grammar built at a low level can be finalized once with
+    :meth:`fsmcontainer.optimize` before it is deployed. """
+    global _defaultOptimizationLevel
+    _defaultOptimizationLevel = _checkOptimizationLevel(level)
+
+
+@contextmanager
+def optimization_level(level):
+    """ Apply an optimization level for the duration of a ``with`` block in
+    the current thread, restoring the previous level afterwards. """
+    token = _optimizationLevel.set(_checkOptimizationLevel(level))
+    try:
+        yield level
+    finally:
+        _optimizationLevel.reset(token)
+
+
+_hashEngineLimit = 256
+
+
+def get_hash_engine_limit():
+    """ Return the largest number of items a container built from explicit
+    items keeps in a Python hash structure rather than compiling. """
+    return _hashEngineLimit
+
+
+def set_hash_engine_limit(limit):
+    """ Set the largest number of items (or key-value pairs) that a container
+    built from explicit items keeps in a Python hash structure. Membership,
+    lookup, ``len``, iteration and set algebra between such containers are
+    then plain set and dict operations, and an FST is compiled only when an
+    operation needs one. Set to 0 to always compile. """
+    global _hashEngineLimit
+    if limit < 0:
+        raise ValueError("limit must not be negative")
+    _hashEngineLimit = limit
@@ -3,11 +3,25 @@
 # TODO: top/bottom rather than key/value terminology
 
 import collections
+import functools
+import itertools
 import six
+import threading
 import operator
-import pynini
-import pywrapfst
+try:
+    import pynini
+    import pywrapfst
+except ImportError:
+    # Pynini is only needed to build machines. Precompiled machines can be
+    # served through the NumPy engine in arrays.py without it.
+    pynini = pywrapfst = None
 from .serializers import Serializer
+from .graph import (StateGraph, functionalityWitness, tokenize, detokenize,
+                    canonical, differenceWitness, intersectionWitness,
+                    samplePaths)
+from .graph import accepts as graphAccepts, concatenate as joinSerialized
+from .settings import (get_resource_limits, get_optimization_level,
+                       get_hash_engine_limit)
 
 NotImplemented = False
 
@@ -33,7 +47,7 @@ class EngineWrapper(object):
     def union(self, other):
         return NotImplemented
 
-    def priorityUnion(self, other):
+    def priorityUnion(self, *others):
         return NotImplemented
 
     def intersect(self, other):
@@ -65,19 +79,198 @@ class EngineWrapper(object):
                     leftBottomTape=False, rightBottomTape=False):
         return NotImplemented
 
-    def findAmbiguity(self, strictness):
+    def findAmbiguity(self, strictness=None):
         return NotImplemented
 
+    def isFunctional(self):
+        return NotImplemented
 
-def _constructiveOp(op):
+    def differenceWitness(self, other, side="top"):
+        """ Return a string on *side* of this machine but not of *other*,
+        or None if there is none. Searches the two machines' graphs side by
+        side and stops at the first witness, without building the
+        difference. """
+        index = 0 if side == "top" else 1
+        return differenceWitness(self.graph(), other.graph(), index)
+
+    def samplePaths(self, k, rng, maxLength=None):
+        """ Draw *k* (input, output) pairs uniformly at random from the
+        paths of this machine's optimized form; see
+        :func:`graph.samplePaths`. """
+        return samplePaths(self.optimized().graph(), k, rng, maxLength)
+
+    def intersectionWitness(self, other, side="top"):
+        """ Return a string on *side* of both this machine and *other*, or
+        None if there is none, without building the intersection. """
+        if getattr(other, "engine", None) == "set":
+            return other.intersectionWitness(self, side)
+        index = 0 if side == "top" else 1
+        return intersectionWitness(self.graph(), other.graph(), index)
+
+
+def _limited(opname, estimate=None):
+    """ Decorator that enforces the current resource limits around a wrapper
+    method returning a new wrapper: the deadline is checked before and after
+    the operation, *estimate* (if given) is called with the method's arguments
+    to reject hopeless operations before they run, and the size of the result
+    is checked afterwards. """
+    def decorator(method):
+        @functools.wraps(method)
+        def innerFunction(self, *args, **kwargs):
+            limits = get_resource_limits()
+            if not limits.active:
+                return method(self, *args, **kwargs)
+            limits.checkDeadline(opname)
+            if estimate is not None:
+                limits.checkEstimate(opname, estimate(self, *args))
+            result = method(self, *args, **kwargs)
+            limits.checkDeadline(opname)
+            limits.checkSize(opname, result.numStates(), result.numArcs)
+            return result
+        return innerFunction
+    return decorator
+
+def _productEstimate(self, other):
+    """ Upper bound on the states of a composition-like product. """
+    return self.numStates() * other.numStates()
+
+def _sumEstimate(self, other):
+    """ Upper bound on the states of a union or concatenation. """
+    return self.numStates() + other.numStates() + 1
+
+def _priorityEstimate(self, *others):
+    """ Upper bound on the states of a priority union. """
+    return self.numStates() + sum(self.numStates() * other.numStates() + 1
+                                  for other in others)
+
+def _optimizeInPlace(fsm, level):
+    """ Optimize a machine that nothing else refers to yet. """
+    if level == "cheap":
+        fsm.rmepsilon()
+        fsm.connect()
+    elif level == "full":
+        fsm.optimize()
+    return fsm
+
+def _constructiveOp(opname, estimate=None):
+    """ Return a wrapper method applying the Pynini function *opname* to the
+    machines of two wrappers. The function is looked up when the method is
+    called, so that this module imports without Pynini. """
     def innerFunction(self, other):
         cls = type(self)
-        return cls(op(self.fsm, other.fsm))
-    return innerFunction
+        return cls.fromResult(getattr(pynini, opname)(self.fsm, other.fsm))
+    return _limited(opname, estimate)(innerFunction)
 
 class PyniniWrapper(EngineWrapper):
+    """ Wraps a Pynini machine.
+
+    Wrapped machines are treated as immutable, so wrappers, and containers
+    and their copies, share them freely; an operation that needs a modified
+    machine clones it first with :meth:`_clonedFsm`, and only then. Results
+    of constructive operations are new machines that nothing else refers to,
+    and are optimized in place before they are wrapped. Projection and
+    inversion return lazy views of their source, which answer membership
+    questions by consulting the source and build a machine of their own only
+    when one is needed.
+
+    Since nothing is modified after it is wrapped, any number of threads can
+    read from one wrapper at once. Derived data (optimized and arc-sorted
+    machines, graphs, materialized views) is computed under a per-wrapper
+    lock, once, and then shared. """
+
+    engine = "pynini"
+
     def __init__(self, fsm):
-        self.fsm = fsm
+        self._fsm = fsm
+        self._source = None
+        self._transform = None
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def _cached(self, key, compute):
+        """ Return the cached value for *key*, computing it under this
+        wrapper's lock the first time. The lock is reentrant, since computing
+        one derived value often needs another. """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    def __getstate__(self):
+        # Machines pickle as OpenFst's binary format. Views are materialized,
+        # and cached derived machines are left to be recomputed.
+        return {"fsm": self.fsm.write_to_string()}
+
+    def __setstate__(self, state):
+        self.__init__(pynini.Fst.read_from_string(state["fsm"]))
+
+    @property
+    def fsm(self):
+        if self._fsm is None:
+            with self._lock:
+                if self._fsm is None:
+                    self._fsm = self._materialize()
+        return self._fsm
+
+    @classmethod
+    def view(cls, source, transform, side=None):
+        """ Return a lazy view applying *transform* ("project" or "invert")
+        to *source*. *side* is the side kept by a projection. """
+        obj = cls(None)
+        obj._source = source
+        obj._transform = (transform, side)
+        return obj
+
+    def _materialize(self):
+        transform, side = self._transform
+        fsm = self._source._clonedFsm()
+        if transform == "project":
+            return fsm.project("output" if side == "bottom" else "input")
+        return fsm.invert()
+
+    def _clonedFsm(self):
+        """ Return a private copy of this wrapper's machine, safe to modify.
+        """
+        return self.fsm.copy()
+
+    def _sourceSide(self, side):
+        """ The side of the source machine that *side* of this view reads. """
+        transform, projectedSide = self._transform
+        if transform == "project":
+            return projectedSide
+        return {"top": "bottom", "bottom": "top"}[side]
+
+    @classmethod
+    def fromResult(cls, fsm):
+        """ Wrap a machine freshly built by a constructive operation,
+        optimizing it in place according to the current optimization level.
+        """
+        level = get_optimization_level()
+        obj = cls(_optimizeInPlace(fsm, level))
+        if level == "full":
+            obj._cache["optimized"] = obj
+        return obj
+
+    def optimize(self, level="full"):
+        """ Return a copy of this wrapper optimized to *level* (see
+        :func:`set_optimization_level`). """
+        cls = type(self)
+        if level == "full" and "optimized" in self._cache:
+            return self._cache["optimized"]
+        obj = cls(_optimizeInPlace(self._clonedFsm(), level))
+        if level == "full":
+            obj._cache["optimized"] = obj
+        return obj
+
+    def optimized(self):
+        """ Return a fully optimized version of this wrapper, computing it
+        only once. Deterministic, minimal machines have exactly one path per
+        distinct item, which counting and enumeration rely on. """
+        return self._cached("optimized", lambda: self.optimize("full"))
 
     @classmethod
     def fromPairs(cls, pairs):
@@ -94,6 +287,24 @@ class PyniniWrapper(EngineWrapper):
                 raise ValueError
             yield (k, v)
 
+    @classmethod
+    def fromTriples(cls, triples):
+        """ Build a weighted machine from (input, output, weight) triples.
+        Weights are tropical: lower is better, and once the machine is
+        optimized, a pair listed more than once keeps its lowest weight. """
+        fsm = pynini.string_map(
+                ((k, v, str(w)) for k, v, w in cls.encodeTriples(triples)),
+                input_token_type="utf8",
+                output_token_type="utf8")
+        return cls(fsm)
+
+    @classmethod
+    def encodeTriples(cls, triples):
+        for k, v, w in triples:
+            if "\x00" in k or "\x00" in v:
+                raise ValueError
+            yield (k, v, w)
+
     @classmethod
     def fromItems(cls, items):
         pairs = cls.encodePairs(zip(items, items))
@@ -109,21 +320,31 @@ class PyniniWrapper(EngineWrapper):
         fsm = pynini.Fst.read(filename)
         return cls(fsm)
 
+    def write(self, filename):
+        self.fsm.write(filename)
+
     @classmethod
     def transducer(cls, fsm1, fsm2):
-        if not isinstance(fsm1, cls):
+        if not isinstance(fsm1, EngineWrapper):
             fsm1 = PyniniWrapper.fromItem(fsm1)
-        if not isinstance(fsm2, PyniniWrapper):
+        if not isinstance(fsm2, EngineWrapper):
             fsm2 = PyniniWrapper.fromItem(fsm2)
         fsm = pynini.transducer(fsm1.fsm, fsm2.fsm)
         return cls(fsm)
 
     def __eq__(self, other):
+        if isinstance(other, SetWrapper):
+            return other == self
+        # Encoding turns an epsilon:epsilon arc into an ordinary label, so
+        # compare the optimized machines, which have none left.
         em = pynini.EncodeMapper("standard", True, True)
-        return pynini.equivalent(pynini.encode(self.fsm, em).optimize(), 
-                                 pynini.encode(other.fsm, em).optimize())
+        return pynini.equivalent(
+                pynini.encode(self.optimized().fsm, em).optimize(),
+                pynini.encode(other.optimized().fsm, em).optimize())
 
     def accepts(self, item, side="top"):
+        if self._transform is not None and self._fsm is None:
+            return self._source.accepts(item, side=self._sourceSide(side))
         cls = type(self)
         wrappedItem = cls.fromPairs([(item, item)])
         if side == "top":
@@ -134,30 +355,57 @@ class PyniniWrapper(EngineWrapper):
         return len(list(paths)) == 1
 
     def pathIterator(self, limit=None, side=None):
+        fsm = self.optimized().fsm
         if limit is None:
             try:
-                stringpaths = self.fsm.paths(
-                    input_token_type='symbol',
-                    output_token_type='symbol')
-            except pywrapfst.FstArgError:
+                paths = _decodedPaths(fsm, side)
+            except pywrapfst.FstOpError:
                 print("Can't iterate over this mapping. It is cyclic and may accept infinitely many keys.")
                 raise
         else:
-            stringpaths = pynini.shortestpath(self.fsm, nshortest=limit).paths(
-                input_token_type='symbol',
-                output_token_type='symbol')
-        if side=="top":
-            for stringpath in stringpaths:
-                yield pynini_decode(stringpath[0])
-        elif side=="bottom":
-            for stringpath in stringpaths:
-                yield pynini_decode(stringpath[1])
+            paths = _decodedPaths(pynini.shortestpath(fsm, nshortest=limit),
+                                  side)
+        for path, _ in paths:
+            yield path
+
+    def weightedPathIterator(self, limit=None, side=None):
+        """ Like :meth:`pathIterator`, but yield (path, weight) pairs, lowest
+        weight first. With *limit*, only the *limit* best distinct paths are
+        found, by OpenFst's n-shortest-paths search, which expands the machine
+        on the fly and stops once it has them. """
+        if limit is None:
+            fsm = self.optimized().fsm
+        elif side is None:
+            # Unique n-best search needs an acceptor, so search over encoded
+            # label pairs.
+            em = pynini.EncodeMapper("standard", True, False)
+            fsm = pynini.shortestpath(pynini.encode(self.fsm, em),
+                                      nshortest=limit, unique=True)
+            fsm.decode(em)
         else:
-            for stringpath in stringpaths:
-                yield (pynini_decode(stringpath[0]),
-                       pynini_decode(stringpath[1]))
-
-    concatenate = _constructiveOp(pynini.concat)
+            # One string on *side* can be spelled by many paths, aligned
+            # differently against the other side, and unique search tells
+            # paths apart by their labels, epsilons included. The
+            # determinized projection has one path per string, with its
+            # best weight.
+            acceptor = pynini.determinize(
+                    pynini.rmepsilon(self.project(side).fsm))
+            fsm = pynini.shortestpath(acceptor, nshortest=limit, unique=True)
+        paths = list(_decodedPaths(fsm, side))
+        paths.sort(key=operator.itemgetter(1))
+        return iter(paths)
+
+    concatenate = _constructiveOp("concat", _sumEstimate)
+
+    def numStates(self):
+        if self._fsm is None:
+            return self._source.numStates()
+        return self.fsm.num_states()
+
+    def numArcs(self):
+        if self._fsm is None:
+            return self._source.numArcs()
+        return sum(self.fsm.num_arcs(state) for state in self.fsm.states())
 
     def numPathsCompare(self, n, op=operator.eq):
         numToTryFor = n+1
@@ -167,47 +415,140 @@ class PyniniWrapper(EngineWrapper):
     def isCyclic(self):
         try: 
             stringpaths = self.fsm.paths()
-        except pywrapfst.FstArgError:
+        except pywrapfst.FstOpError:
             return True
         return False
 
     def hasPaths(self):
         return self.numPathsCompare(0, operator.gt)
 
+    @_limited("intersect", _productEstimate)
     def intersect(self, other):
-        self.fsm.optimize() # Pynini intersection will fail on unoptimized FSAs
-        return _constructiveOp(pynini.intersect)(self, other)
-
-    def union(self, other):
-        obj = _constructiveOp(pynini.union)(self, other)
-        obj.fsm.optimize() # Counting paths is inaccurate after union unless
-                           # we do this. TODO: more robust solution.
-        return obj
-
-    priorityUnion = _constructiveOp(...)
-
-    subtract = _constructiveOp(pynini.difference)
-    compose = _constructiveOp(pynini.compose)
-    lenientlyCompose = _constructiveOp(pynini.leniently_compose)
+        # Pynini intersection will fail on unoptimized FSAs. Use the cached
+        # optimized copy rather than optimizing a machine that may be shared.
+        cls = type(self)
+        return cls.fromResult(pynini.intersect(self.optimized().fsm,
+                                               other.fsm))
+
+    union = _constructiveOp("union", _sumEstimate)
+
+    @_limited("priorityUnion", _priorityEstimate)
+    def priorityUnion(self, *others):
+        """ Return a machine mapping each key of this machine as this
+        machine does, and any other key as the first of *others* that has it
+        does. Each of *others* is restricted to the keys not yet claimed by
+        subtracting the domains before it from its own domain, so nothing is
+        built over a whole alphabet, and the pieces are joined and optimized
+        once, at the end. """
+        cls = type(self)
+        fsm = self._clonedFsm()
+        claimed = self.project("top").fsm
+        for other in others:
+            domain = other.project("top").fsm
+            # Difference needs an unweighted, deterministic second argument.
+            claimed = pynini.arcmap(claimed, map_type="rmweight").optimize()
+            fsm.union(pynini.compose(pynini.difference(domain, claimed),
+                                     other.fsm))
+            claimed = pynini.union(claimed, domain)
+        return cls.fromResult(fsm)
+
+    subtract = _constructiveOp("difference", _productEstimate)
+
+    @_limited("compose", _productEstimate)
+    def compose(self, other):
+        cls = type(self)
+        if (other._transform is not None and other._transform[0] == "invert"
+                and other._fsm is None
+                and self.numStates() < other.numStates()):
+            # self @ inv(B) == inv(B @ inv(self)). Composing with B directly
+            # materializes the inverse of the smaller operand instead of the
+            # inverse of B, so reverse lookups cost no extra copy of B.
+            return other._source.compose(self.invert()).invert()
+        left = self.prepared("left")
+        right = other.prepared("right")
+        if isinstance(left, pynini.Fst):
+            return cls.fromResult(pynini.compose(left, right))
+        # A label-lookahead left operand only helps if OpenFst composes it
+        # in its own type, so bypass Pynini's conversion to a mutable FST.
+        return cls.fromResult(
+                pynini.Fst.from_pywrapfst(pywrapfst.compose(left, right)))
+
+    def prepared(self, side, lookahead=False):
+        """ Return this wrapper's machine prepared to be the *side* ("left" or
+        "right") operand of a composition: arc-sorted by output label on the
+        left, by input label on the right, and optionally (left side only)
+        converted to OpenFst's label-lookahead representation. The result is
+        cached, so a grammar that takes part in many compositions or lookups
+        is only sorted once. Machines are never sorted in place, since they
+        may be shared. """
+        if side not in {"left", "right"}:
+            raise ValueError
+        lookahead = lookahead and side == "left"
+        if not lookahead and ("prepared", side, True) in self._cache:
+            return self._cache[("prepared", side, True)]
+        return self._cached(("prepared", side, lookahead),
+                            lambda: self._prepare(side, lookahead))
+
+    def _prepare(self, side, lookahead):
+        sortType, sortedProperty = (("olabel", pywrapfst.O_LABEL_SORTED)
+                                    if side == "left" else
+                                    ("ilabel", pywrapfst.I_LABEL_SORTED))
+        fsm = self.fsm
+        if not fsm.properties(sortedProperty, True):
+            fsm = self._clonedFsm().arcsort(sortType)
+        if lookahead:
+            try:
+                fsm = pywrapfst.convert(fsm, "olabel_lookahead")
+            except pywrapfst.FstError:
+                # OpenFst was built without the lookahead extension; an
+                # arc-sorted machine is the best we can do.
+                pass
+        return fsm
+
+    def prepareForComposition(self, lookahead=False):
+        """ Compute and cache the prepared machines for both sides of a
+        composition ahead of time. Returns this wrapper. """
+        self.prepared("left", lookahead)
+        self.prepared("right")
+        return self
+
+    lenientlyCompose = _constructiveOp("leniently_compose",
+                                       _productEstimate)
 
     def project(self, side="top"):
+        """ Return a lazy view of this machine projected onto *side*. """
         if side not in {"top", "bottom"}:
             raise ValueError
-        tf = (side == "bottom")
         cls = type(self)
-        return cls(self.fsm.copy().project(project_output=tf))
+        if self._transform is not None:
+            if self._transform[0] == "project":
+                return self
+            return self._source.project(self._sourceSide(side))
+        return cls.view(self, "project", side)
+
+    def invert(self):
+        """ Return a lazy view of this machine with its sides swapped. """
+        cls = type(self)
+        if self._transform is not None:
+            if self._transform[0] == "invert":
+                return self._source
+            return self
+        return cls.view(self, "invert")
 
+    @_limited("cross", _sumEstimate)
     def cross(self, other):
         cls = type(self)
-        return cls(pynini.transducer(self.fsm, other.fsm))
+        return cls.fromResult(pynini.transducer(self.fsm, other.fsm))
 
+    @_limited("star", lambda self: self.numStates() + 1)
     def star(self):
         cls = type(self)
-        return cls(pynini.closure(self.fsm).optimize())
+        return cls.fromResult(pynini.closure(self.fsm))
 
+    @_limited("plus", lambda self: self.numStates() + 1)
     def plus(self):
         cls = type(self)
-        return cls(pynini.closure(self.fsm, 1).optimize()) #TEST THIS
+        return cls.fromResult(pynini.closure(self.fsm, 1)) #TEST THIS
 
     def sigma(self):
         sigma = set()
@@ -220,6 +561,7 @@ class PyniniWrapper(EngineWrapper):
         cls = type(self)
         return cls.fromPairs((s,s) for s in sigma if "\x00" not in s)
 
+    @_limited("makeRewrite")
     def makeRewrite(self, 
                     leftEnvironment=None, rightEnvironment=None,
                     leftBottomTape=False, rightBottomTape=False,
@@ -232,24 +574,391 @@ class PyniniWrapper(EngineWrapper):
                           .union(right.sigma())
                           .star())
         fsm = pynini.cdrewrite(self.fsm, left.fsm, right.fsm, sigma.fsm)
-        return cls(fsm)
-
-    def findAmbiguity(self, strictness=100):
-        """ Allauzen and Mohri: an FST f is functional (i.e. one-to-one or
-        many-to-one) iff f' .o. f is the identity function over f's domain.
-        Rather than implement A&Z's algorithm to determine strict identity,
-        we test identity for a random sample of paths.
+        return cls.fromResult(fsm)
+
+    def graph(self):
+        """ Return a :class:`StateGraph` view of this machine, building it
+        only once. """
+        if self._fsm is None:
+            return self._cached("graph", lambda: _viewGraph(
+                    self._source.graph(), *self._transform))
+        return self._cached("graph", lambda: _buildGraph(self.fsm))
+
+    def ambiguityWitness(self):
+        """ Return None if this transducer is functional (one-to-one or
+        many-to-one), or an (input, output1, output2) triple showing two
+        different outputs for one input. The test is exact and runs in
+        polynomial time; see :func:`graph.functionalityWitness`. The result
+        is cached. """
+        return self._cached("ambiguity",
+                            lambda: functionalityWitness(self.graph()))
+
+    def isFunctional(self):
+        return self.ambiguityWitness() is None
+
+    def findAmbiguity(self, strictness=None):
+        """ Return None if this transducer is functional, or a pair of
+        different outputs that it gives for the same input. *strictness* is
+        accepted for compatibility with the old sampling-based test and is
+        ignored: the test is now exact.
         """
-        fpcf = self.fsm.copy().invert() * self.fsm
-        for top, bottom, _ in pynini.randgen(fpcf,
-                                             npath=strictness,
-                                             max_length=strictness)\
-                                    .paths(input_token_type="symbol",
-                                           output_token_type="symbol"):
-            if top != bottom:
-                return (clean(top), clean(bottom))
+        witness = self.ambiguityWitness()
+        return witness and witness[1:]
+
+
+def wrapPairs(pairs):
+    """ Wrap (input, output) string pairs in a :class:`SetWrapper` if there
+    are no more of them than the hash engine limit (see
+    :func:`set_hash_engine_limit`), or else compile them. """
+    pairs = list(PyniniWrapper.encodePairs(pairs))
+    if len(pairs) <= get_hash_engine_limit():
+        return SetWrapper(pairs)
+    return _compilePairs(pairs, engine="pynini")
+
+def _compilePairs(pairs, engine):
+    """ Compile string pairs with *engine*, "pynini" or "array". Without
+    Pynini installed, always use the array engine. """
+    if engine == "array" or pynini is None:
+        from .arrays import ArrayWrapper
+        return ArrayWrapper.fromPairs(pairs)
+    return PyniniWrapper.fromPairs(sorted(pairs))
+
+def convertEngine(wrapper, engine):
+    """ Return *wrapper*'s machine wrapped by *engine*: "pynini", "array" or
+    "set". Converting to "set", or from "array" to "pynini", enumerates the
+    machine's paths, so it only works for finite machines. """
+    if engine not in {"pynini", "array", "set"}:
+        raise ValueError("engine must be 'pynini', 'array' or 'set', not %r"
+                         % engine)
+    if wrapper.engine == engine:
+        return wrapper
+    if engine == "array":
+        from .arrays import ArrayWrapper
+        return ArrayWrapper.fromWrapper(wrapper)
+    if engine == "set":
+        return SetWrapper(wrapper.pathIterator())
+    if wrapper.engine == "set":
+        return wrapper.compiled()
+    return PyniniWrapper.fromPairs(wrapper.pathIterator())
+
+
+class SetWrapper(EngineWrapper):
+    """ Wraps a finite relation held as a frozenset of (input, output) string
+    pairs.
+
+    Small containers built from explicit items are all but free to build
+    this way, and answer membership, lookup, ``len`` and iteration with set
+    and dict operations. Set algebra, concatenation, composition and
+    projection between two SetWrappers stay in Python as long as their
+    results stay under the hash engine limit. Anything else (closure,
+    rewrite rules, operations with a compiled machine) compiles the pairs to
+    a :class:`PyniniWrapper`, once, and defers to it; so do any
+    PyniniWrapper methods not defined here.
+
+    Strings are held in their :func:`canonical <graph.canonical>` spelling,
+    so that two spellings of the same string (``'[a]'`` and ``'a'``, say)
+    are the same item here, as they are in a compiled machine. """
+
+    engine = "set"
+    _transform = None
+
+    def __init__(self, pairs):
+        self.pairs = frozenset((canonical(k), canonical(v)) for k, v in pairs)
+        # Indexes for membership on either side and for composition.
+        outputs = collections.defaultdict(set)
+        for k, v in self.pairs:
+            outputs[k].add(v)
+        self._outputs = {k: frozenset(vs) for k, vs in outputs.items()}
+        self._bottoms = frozenset(v for _, v in self.pairs)
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"pairs": self.pairs}
+
+    def __setstate__(self, state):
+        self.__init__(state["pairs"])
+
+    def compiled(self):
+        """ Return a :class:`PyniniWrapper` for the same relation, compiling
+        it the first time. """
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._compiled = _compilePairs(self.pairs, "pynini")
+        return self._compiled
+
+    def _compiledFor(self, other):
+        """ The compiled form of this relation to combine with the compiled
+        machine *other*, in the same engine. """
+        if other.engine == "array":
+            from .arrays import ArrayWrapper
+            return ArrayWrapper.fromPairs(self.pairs)
+        return self.compiled()
+
+    @property
+    def fsm(self):
+        return self.compiled().fsm
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.compiled(), name)
+
+    @staticmethod
+    def _wrap(pairs):
+        if len(pairs) <= get_hash_engine_limit():
+            return SetWrapper(pairs)
+        return _compilePairs(pairs, "pynini")
+
+    def __eq__(self, other):
+        if isinstance(other, SetWrapper):
+            return self.pairs == other.pairs
+        # A compiled machine can align the same pairs differently, so compare
+        # the pairs it spells instead.
+        if other.isCyclic():
+            return False
+        return self.pairs == frozenset(other.pathIterator())
+
+    def accepts(self, item, side="top"):
+        strings = self._outputs if side == "top" else self._bottoms
+        return canonical(item) in strings
+
+    def pathIterator(self, limit=None, side=None):
+        for k, v in itertools.islice(sorted(self.pairs), limit):
+            if side == "top":
+                yield k
+            elif side == "bottom":
+                yield v
+            else:
+                yield (k, v)
+
+    def numStates(self):
+        # The size of a trie over the longer side of each pair: an upper
+        # bound on the states of the compiled machine, for estimates.
+        return 1 + sum(max(len(k), len(v)) for k, v in self.pairs)
+
+    def numArcs(self):
+        return self.numStates() - 1
+
+    def numPathsCompare(self, n, op=operator.eq):
+        return op(len(self.pairs), n)
+
+    def isCyclic(self):
+        return False
+
+    def hasPaths(self):
+        return bool(self.pairs)
+
+    def _firstWitness(self, other, side, wanted):
+        """ The shortest string on *side* of this relation for which
+        membership in *other* is *wanted*. Membership in a compiled machine
+        is checked by walking its graph. """
+        index = 0 if side == "top" else 1
+        strings = sorted(self._outputs if index == 0 else self._bottoms,
+                         key=lambda string: (len(string), string))
+        if isinstance(other, SetWrapper):
+            theirs = other._outputs if index == 0 else other._bottoms
+            found = (string for string in strings
+                     if (string in theirs) == wanted)
+        else:
+            otherGraph = other.graph()
+            found = (string for string in strings
+                     if graphAccepts(otherGraph, tokenize(string),
+                                     index) == wanted)
+        return next(found, None)
+
+    def differenceWitness(self, other, side="top"):
+        return self._firstWitness(other, side, wanted=False)
+
+    def samplePaths(self, k, rng, maxLength=None):
+        pairs = sorted(self.pairs)
+        if maxLength is not None:
+            # The compiled machine spells each pair with one arc per token
+            # of its longer side.
+            pairs = [pair for pair in pairs
+                     if max(map(len, map(tokenize, pair))) <= maxLength]
+        if not pairs:
+            raise ValueError("Can't sample from a machine with no paths")
+        return [rng.choice(pairs) for _ in range(k)]
+
+    def intersectionWitness(self, other, side="top"):
+        return self._firstWitness(other, side, wanted=True)
+
+    def concatenate(self, other):
+        if (isinstance(other, SetWrapper) and len(self.pairs) *
+                len(other.pairs) <= get_hash_engine_limit()):
+            return SetWrapper((joinSerialized(k1, k2), joinSerialized(v1, v2))
+                              for k1, v1 in self.pairs
+                              for k2, v2 in other.pairs)
+        return self._compiledFor(other).concatenate(other)
+
+    def union(self, other):
+        if isinstance(other, SetWrapper):
+            return self._wrap(self.pairs | other.pairs)
+        return self._compiledFor(other).union(other)
+
+    def priorityUnion(self, *others):
+        if not all(isinstance(other, SetWrapper) for other in others):
+            return self._compiledFor(others[0]).priorityUnion(*others)
+        pairs = set(self.pairs)
+        claimed = {k for k, _ in self.pairs}
+        for other in others:
+            pairs.update(pair for pair in other.pairs
+                         if pair[0] not in claimed)
+            claimed.update(k for k, _ in other.pairs)
+        return self._wrap(pairs)
+
+    def intersect(self, other):
+        if isinstance(other, SetWrapper):
+            return SetWrapper(self.pairs & other.pairs)
+        return self._compiledFor(other).intersect(other)
+
+    def subtract(self, other):
+        if isinstance(other, SetWrapper):
+            return SetWrapper(self.pairs - other.pairs)
+        return self._compiledFor(other).subtract(other)
+
+    def compose(self, other):
+        if not isinstance(other, SetWrapper):
+            return self._compiledFor(other).compose(other)
+        return self._wrap({(k, v2) for k, v in self.pairs
+                           for v2 in other._outputs.get(v, ())})
+
+    def lenientlyCompose(self, other):
+        return self._compiledFor(other).lenientlyCompose(other)
+
+    def project(self, side="top"):
+        if side not in {"top", "bottom"}:
+            raise ValueError
+        index = 0 if side == "top" else 1
+        return SetWrapper((pair[index], pair[index]) for pair in self.pairs)
+
+    def invert(self):
+        return SetWrapper((v, k) for k, v in self.pairs)
+
+    def cross(self, other):
+        if (isinstance(other, SetWrapper) and len(self.pairs) *
+                len(other.pairs) <= get_hash_engine_limit()):
+            return SetWrapper((k, v) for k, _ in self.pairs
+                              for _, v in other.pairs)
+        return self._compiledFor(other).cross(other)
+
+    def star(self):
+        return self.compiled().star()
+
+    def plus(self):
+        return self.compiled().plus()
+
+    def sigma(self):
+        sigma = {detokenize([token]) for pair in self.pairs
+                 for string in pair for token in tokenize(string)}
+        return SetWrapper((symbol, symbol) for symbol in sigma)
+
+    def makeRewrite(self, *args, **kwargs):
+        return self.compiled().makeRewrite(*args, **kwargs)
+
+    def ambiguityWitness(self):
+        outputs = {}
+        for k, v in sorted(self.pairs):
+            if outputs.setdefault(k, v) != v:
+                return (k, outputs[k], v)
         return None
 
+    def isFunctional(self):
+        return self.ambiguityWitness() is None
+
+    def findAmbiguity(self, strictness=None):
+        witness = self.ambiguityWitness()
+        return witness and witness[1:]
+
+
+# Pynini labels the bracketed multi-character tokens of strings compiled
+# without a symbol table from here up, in its table of generated symbols.
+GENERATED_LABELS_START = 0xF0000
+
+def _symbolText(symbol):
+    if isinstance(symbol, bytes):
+        return symbol.decode("utf8")
+    return symbol
+
+def _labelDecoder(symbols):
+    """ Return a function turning labels into the graph labels they stand
+    for (see :mod:`graph`), with the empty string for epsilon. """
+    decoded = {0: ""}
+    def decode(label):
+        try:
+            return decoded[label]
+        except KeyError:
+            if symbols is not None:
+                string = from_att_symbol(_symbolText(symbols.find(label)))
+            elif label >= GENERATED_LABELS_START:
+                # "[]" is generated too, as the empty symbol, and find
+                # returns an empty symbol for labels it does not know.
+                generated = pynini.generated_symbols()
+                token = _symbolText(generated.find(label))
+                if generated.find(token) == label:
+                    string = "[" + token + "]"
+                else:
+                    string = six.unichr(label)
+            else:
+                string = six.unichr(label)
+            decoded[label] = string
+            return string
+    return decode
+
+def _buildGraph(fsm):
+    idecode = _labelDecoder(fsm.input_symbols())
+    odecode = _labelDecoder(fsm.output_symbols())
+    arcs = []
+    finals = {}
+    for state in fsm.states():
+        arcs.append([(idecode(arc.ilabel), odecode(arc.olabel),
+                      float(str(arc.weight)), arc.nextstate)
+                     for arc in fsm.arcs(state)])
+        final = float(str(fsm.final(state)))
+        if final != float("inf"):
+            finals[state] = final
+    start = fsm.start()
+    return StateGraph(start if start >= 0 else None, arcs, finals)
+
+def _viewGraph(graph, transform, side):
+    """ Relabel *graph* for a projection or inversion view, sharing its
+    states. """
+    if transform == "invert":
+        arcs = [[(o, i, w, n) for i, o, w, n in stateArcs]
+                for stateArcs in graph.arcs]
+    elif side == "top":
+        arcs = [[(i, i, w, n) for i, o, w, n in stateArcs]
+                for stateArcs in graph.arcs]
+    else:
+        arcs = [[(o, o, w, n) for i, o, w, n in stateArcs]
+                for stateArcs in graph.arcs]
+    return StateGraph(graph.start, arcs, graph.finals)
+
+
+def _decodedPaths(fsm, side):
+    """ Return an iterator over the paths of the acyclic machine *fsm*, each
+    as a ``(path, weight)`` pair. The path is spelled from its labels as in
+    :func:`_buildGraph`: its input string, its output string, or both,
+    depending on *side*. Raises FstOpError at once if *fsm* is cyclic. """
+    idecode = _labelDecoder(fsm.input_symbols())
+    odecode = _labelDecoder(fsm.output_symbols())
+    paths = fsm.paths()
+    def decode():
+        while not paths.done():
+            top = detokenize(map(idecode, paths.ilabels()))
+            bottom = detokenize(map(odecode, paths.olabels()))
+            weight = float(str(paths.weight()))
+            if side == "top":
+                yield top, weight
+            elif side == "bottom":
+                yield bottom, weight
+            else:
+                yield (top, bottom), weight
+            paths.next()
+    return decode()
+
 
 def pynini_decode(inputBytes):
     """ Pynini often outputs bytestrings with unprintable characters
@@ -257,11 +966,12 @@ def pynini_decode(inputBytes):
     """
     asString = inputBytes.decode("utf8")
     asTokens = (from_att_symbol(symbol) for symbol in asString.split(' '))
-    return "".join(asTokens)
+    return detokenize(asTokens)
 
 def from_att_symbol(string):
     """ OpenFST outputs symbol table representations in an awkward
-    format. Attempt to deal with that gracefully. """
+    format. Attempt to deal with that gracefully, returning the graph label
+    the symbol stands for (see :mod:`graph`). """
     # pylint: disable=too-many-return-statements
     if string.startswith("<0"):
         return six.unichr(int(string.strip('<>'), 16))
@@ -280,12 +990,6 @@ def from_att_symbol(string):
         }[string.strip('<>')]
     if len(string) > 1:
         return "[" + string + "]"
-    if string == "[":
-        return "\\["
-    if string == "]":
-        return "\\]"
-    if string == "\\":
-        return "\\\\"
     return string
 
 
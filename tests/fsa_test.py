@@ -6,6 +6,7 @@ from hypothesis import given, assume, reject
 from hypothesis.strategies import *
 from hypothesis.stateful import RuleBasedStateMachine, Bundle, rule
 from fsmcontainers import *
+from fsmcontainers.fsmcontainers import graph
 import random
 
 usabletext = lambda: text(alphabet=characters(
@@ -67,4 +68,209 @@ def test_concatenation(xs, ys):
         for y in ys:
             assert x + y in zset
 
+@given(lists(usabletext()), lists(tuples(booleans(), usabletext())))
+def test_mutable_fsa_mirrors_set(xs, changes):
+    a = mutablefsa(xs)
+    b = set(xs)
+    for adding, x in changes:
+        if adding:
+            a.add(x)
+            b.add(x)
+        else:
+            a.discard(x)
+            b.discard(x)
+        assert (x in a) == (x in b)
+    assert a == b
 
+@given(dictionaries(usabletext(), integers(0, 100)))
+def test_weighted_items_are_ordered_by_weight(d):
+    a = wfsa(d)
+    items = list(a.weighted_items())
+    assert sorted(items, key=lambda iw: (iw[1], iw[0])) == sorted(
+            ((i, float(w)) for i, w in d.items()),
+            key=lambda iw: (iw[1], iw[0]))
+    assert [w for _, w in items] == sorted(w for _, w in items)
+    assert set(a) == set(d)
+
+def levenshtein(a, b):
+    row = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        previous, row = row, [i]
+        for j, y in enumerate(b, 1):
+            row.append(min(row[j-1] + 1, previous[j] + 1,
+                           previous[j-1] + (x != y)))
+    return row[-1]
+
+# Strings with escaped and unescaped backslashes, escaped brackets and
+# multi-character tokens.
+escapedtext = lambda **kwargs: lists(
+    sampled_from(["a", "b", "é", "[", "]", "\\", "[xy]"]),
+    **kwargs).map(graph.detokenize)
+
+@given(lists(escapedtext(max_size=5)), escapedtext(max_size=5),
+       integers(0, 2))
+def test_fuzzy_lookup_matches_brute_force(xs, word, k):
+    a = fsa(xs)
+    def distance(x):
+        return levenshtein(graph.tokenize(word), graph.tokenize(x))
+    expected = sorted(((x, distance(x)) for x in set(xs)
+                       if distance(x) <= k),
+                      key=lambda match: (match[1], match[0]))
+    assert a.fuzzy_lookup(word, max_distance=k) == expected
+    assert all(x in a for x, _ in expected)
+
+@composite
+def prefixes(draw, xs):
+    """ Draw a prefix of one of *xs* or of another string, cut at a token
+    boundary or inside a bracketed token, and return it with the tokens it
+    spells in full and the start of the token it cuts short. """
+    text = draw(sampled_from(xs) if xs else escapedtext(max_size=3))
+    spans = graph.tokenSpans(text)
+    k = draw(integers(0, len(spans)))
+    tokens, cut, partial = [t for t, _, _ in spans[:k]], 0, ""
+    if k:
+        cut = spans[k-1][2]
+        # A prefix ending in a lone backslash could be the start of an
+        # escape, which is tested separately.
+        assume(text[spans[k-1][1]:cut] != "\\")
+    if k < len(spans) and len(spans[k][0]) > 1:
+        partial = spans[k][0][:draw(integers(0, len(spans[k][0]) - 1))]
+    return text[:cut] + partial, tokens, partial
+
+def starts_with(x, tokens, partial):
+    xs = graph.tokenize(x)
+    if xs[:len(tokens)] != tokens:
+        return False
+    following = xs[len(tokens):len(tokens) + 1]
+    return not partial or (following != [] and len(following[0]) > 1 and
+                           following[0].startswith(partial))
+
+@given(lists(escapedtext(max_size=5)), data())
+def test_completions_match_filtered_elements(xs, d):
+    a = fsa(xs)
+    prefix, tokens, partial = d.draw(prefixes(xs))
+    expected = sorted({x for x in xs if starts_with(x, tokens, partial)},
+                      key=lambda x: (len(graph.tokenize(x)),
+                                     graph.tokenize(x)))
+    assert list(a.completions(prefix)) == expected
+    assert list(a.completions(prefix, limit=2)) == expected[:2]
+    assert a.has_prefix(prefix) == bool(expected)
+
+def test_completions_after_a_trailing_backslash():
+    a = fsa('x\\y', 'x\\[', 'x[yz]', 'xy')
+    assert sorted(a.completions('x\\')) == ['x\\[', 'x\\y']
+    assert a.has_prefix('[') is False and a.has_prefix('x[y')
+
+@given(dictionaries(escapedtext(max_size=5), integers(0, 100)), data())
+def test_weight_ranked_completions_come_best_first(d, data):
+    prefix, tokens, partial = data.draw(prefixes(sorted(d)))
+    expected = sorted((x for x in d if starts_with(x, tokens, partial)),
+                      key=lambda x: (d[x], x))
+    got = list(wfsa(d).completions(prefix, rank="weight"))
+    assert sorted(got) == sorted(expected)
+    assert [d[x] for x in got] == [d[x] for x in expected]
+
+@given(lists(escapedtext(max_size=6), min_size=1))
+def test_index_and_word_at_follow_sorted_order(xs):
+    a = fsa(xs)
+    for i, x in enumerate(sorted(set(xs), key=graph.tokenize)):
+        assert a.index(x) == i
+        assert a.word_at(i) == x
+    with pytest.raises(IndexError):
+        a.word_at(len(set(xs)))
+
+def test_index_of_bracketed_and_escaped_elements():
+    a = fsa('[ab]', 'a\\[', 'x\\y', '\\\\')
+    assert [a.word_at(a.index(x)) for x in a] == list(a)
+    assert a.word_at(a.index('[ab]')) == '[ab]'
+    assert a.word_at(a.index('x\\y')) == 'x\\y'
+    with pytest.raises(KeyError):
+        a.index('ab')
+
+@given(lists(usabletext()), lists(usabletext()), lists(usabletext()))
+def test_complement_ops_mirror_set_ops(xs, ys, probes):
+    x, y, notY = fsa(xs), fsa(ys), ~fsa(ys)
+    for p in probes + ys:
+        assert (p in notY) == (p not in set(ys))
+        assert (p in notY | x) == (p in set(xs) or p not in set(ys))
+        assert (p in notY - x) == (p not in set(xs) | set(ys))
+    assert x & notY == fsa(set(xs) - set(ys))
+    assert notY & x == fsa(set(xs) - set(ys))
+    assert x - notY == fsa(set(xs) & set(ys))
+    assert ~notY == y
+    assert ~x & notY == ~(x | y)
+
+@given(lists(usabletext()), lists(usabletext()))
+def test_witnesses_mirror_set_ops(xs, ys):
+    x, y = fsa(xs), fsa(ys)
+    missing = x.difference_witness(y)
+    assert (missing is None) == (not set(xs) - set(ys))
+    assert missing is None or missing in set(xs) - set(ys)
+    common = x.intersection_witness(y)
+    assert (common is None) == (not set(xs) & set(ys))
+    assert common is None or common in set(xs) & set(ys)
+    assert x.issubset(~y) == set(xs).isdisjoint(ys)
+    assert x.isdisjoint(~y) == set(xs).issubset(ys)
+
+@given(lists(text(alphabet="abc", max_size=5), min_size=1), integers())
+def test_samples_are_elements_and_repeatable(xs, seed):
+    a = fsa(xs)
+    samples = a.sample(20, seed=seed)
+    assert len(samples) == 20
+    assert set(samples) <= set(xs)
+    assert a.sample(20, seed=seed) == samples
+
+def test_bounded_samples_from_cyclic_acceptor():
+    samples = fsa('ab').star().sample(50, seed=0, max_length=6)
+    assert set(samples) <= {'', 'ab', 'abab', 'ababab'}
+    with pytest.raises(ValueError):
+        fsa('ab').star().sample(1)
+
+def brute_force_matches(words, text, overlapping, longest):
+    found = [(s, e) for s in range(len(text))
+             for e in range(s + 1, len(text) + 1) if text[s:e] in words]
+    if overlapping and not longest:
+        return found
+    best = {}
+    for s, e in found:
+        best[s] = (max if longest else min)(best.get(s, e), e)
+    if overlapping:
+        return sorted(best.items())
+    matches, lastEnd = [], 0
+    for s in sorted(best):
+        if s >= lastEnd:
+            matches.append((s, best[s]))
+            lastEnd = best[s]
+    return matches
+
+@given(lists(text(alphabet="ab", min_size=1, max_size=4), min_size=1),
+       text(alphabet="abc"), booleans(), booleans(),
+       lists(integers(min_value=0, max_value=30), max_size=3))
+def test_finditer_matches_brute_force(xs, t, overlapping, longest, cuts):
+    a = fsa(xs)
+    expected = brute_force_matches(set(xs), t, overlapping, longest)
+    assert [(s, e) for s, e, _ in a.finditer(t, overlapping, longest)] == expected
+    cuts = sorted(min(cut, len(t)) for cut in cuts)
+    chunks = [t[i:j] for i, j in zip([0] + cuts, cuts + [len(t)])]
+    streamed = list(a.finditer_stream(chunks, overlapping, longest))
+    assert [(s, e) for s, e, _ in streamed] == expected
+    assert all(t[s:e] == match for s, e, match in streamed)
+
+@given(lists(escapedtext(min_size=1, max_size=3), min_size=1),
+       escapedtext(max_size=10), booleans(), booleans(),
+       lists(integers(min_value=0, max_value=30), max_size=3))
+def test_finditer_matches_tokens_with_escapes(xs, t, overlapping, longest,
+                                              cuts):
+    a = fsa(xs)
+    spans = graph.tokenSpans(t)
+    offsets = [0] + [end for _, _, end in spans]
+    tokens = tuple(token for token, _, _ in spans)
+    expected = [(offsets[s], offsets[e]) for s, e in brute_force_matches(
+            {tuple(graph.tokenize(x)) for x in xs}, tokens, overlapping,
+            longest)]
+    found = list(a.finditer(t, overlapping, longest))
+    assert [(s, e) for s, e, _ in found] == expected
+    assert all(t[s:e] == match and match in a for s, e, match in found)
+    cuts = sorted(min(cut, len(t)) for cut in cuts)
+    chunks = [t[i:j] for i, j in zip([0] + cuts, cuts + [len(t)])]
+    assert list(a.finditer_stream(chunks, overlapping, longest)) == found
@@ -1,3 +1,4 @@
+import collections
 import unicodedata
 import pytest
 import six
@@ -5,7 +6,10 @@ from hypothesis import given, assume, reject
 from hypothesis.strategies import *
 from hypothesis.stateful import RuleBasedStateMachine, Bundle, rule
 from fsmcontainers import *
+from fsmcontainers.fsmcontainers import graph
 import random
+import asyncio
+import pickle
 
 usabletext = lambda: text(alphabet=characters(
     blacklist_characters=['\0', '\1'],
@@ -13,6 +17,11 @@ usabletext = lambda: text(alphabet=characters(
 
 transducertext = lambda: lists(tuples(usabletext(), usabletext()))
 
+# Strings with escaped and unescaped backslashes, escaped brackets and
+# multi-character tokens.
+escapedtext = lambda: lists(sampled_from(["a", "b", "[", "]", "\\", "[xy]"]),
+                            max_size=4).map(graph.detokenize)
+
 kwargdicts = lambda: one_of(dictionaries(usabletext(), usabletext()),
                              dictionaries(usabletext(),
                                  tuples(usabletext(), usabletext())))
@@ -102,3 +111,195 @@ def test_keys_items_and_values_have_same_length(d):
     assert len(list(d.keys())) == len(list(d.values())) == len(list(d.items()))
 
 
+
+@given(dictionaries(usabletext(), usabletext(), min_size=1), usabletext())
+def test_frozen_lookups_match_unfrozen_lookups(d, missing):
+    a = fst(d)
+    frozen = a.freeze()
+    for k, v in d.items():
+        assert k in frozen
+        assert frozen[k] == a[k] == v
+    if missing not in d:
+        assert missing not in frozen
+        with pytest.raises(KeyError):
+            frozen[missing]
+
+@given(dictionaries(escapedtext(), escapedtext(), min_size=1),
+       escapedtext(), sampled_from(["set", "pynini"]))
+def test_frozen_lookups_match_unfrozen_lookups_with_escapes(d, other,
+                                                            engine):
+    a = fst(d).with_engine(engine)
+    frozen = a.freeze()
+    for k, v in d.items():
+        assert k in frozen and k in a
+        assert frozen[k] == a[k] == v
+    assert (other in frozen) == (other in a)
+
+def test_frozen_lookups_from_many_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    d = {str(i): str(i * i) for i in range(200)}
+    frozen = fst(d).freeze()
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(frozen.__getitem__, d.keys()))
+    assert results == list(d.values())
+
+@given(dictionaries(usabletext(), usabletext(), min_size=1))
+def test_async_lookups_match_sync_lookups(d):
+    a = fst(d)
+    async def lookups():
+        singles = await asyncio.gather(*(a.aget(k) for k in d))
+        many = await a.aget_many(list(d))
+        streamed = [v async for k, v in a.astream(list(d))]
+        return singles, many, streamed
+    singles, many, streamed = asyncio.run(lookups())
+    assert singles == many == streamed == list(d.values())
+
+def test_close_shuts_down_only_an_owned_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    with fst({'a': '1'}).with_executor("thread", workers=2) as d:
+        assert asyncio.run(d.aget('a')) == '1'
+        owned = d.asyncExecutor
+    with pytest.raises(RuntimeError):
+        owned.submit(int)
+    assert asyncio.run(d.aget('a')) == '1'
+    with ThreadPoolExecutor(1) as mine:
+        fst({'a': '1'}).with_executor(mine).close()
+        assert mine.submit(int).result() == 0
+
+def test_async_stream_cleans_up_after_a_missing_key():
+    d = fst({'a': '1', 'b': '2'}).with_executor("thread", max_pending=4)
+    def leftover():
+        return [task for task in asyncio.all_tasks()
+                if task is not asyncio.current_task()]
+    async def lookups():
+        seen = []
+        with pytest.raises(KeyError):
+            async for key, value in d.astream(['a', 'zz'] + ['b'] * 20):
+                seen.append((key, value))
+        assert seen == [('a', '1')] and leftover() == []
+        stream = d.astream(['b'] * 20)
+        async for key, value in stream:
+            break
+        await stream.aclose()
+        assert leftover() == []
+    asyncio.run(lookups())
+    d.close()
+
+@given(fsts())
+def test_pickle_roundtrip(d):
+    e = pickle.loads(pickle.dumps(d.with_lookup_cache()))
+    assert e == d
+    assert e.keySerializer is d.keySerializer
+
+def test_lookup_cache_keeps_tuple_keys_in_order():
+    plain = fst({('a', 'b'): 'x', ('b', 'c'): 'y'})
+    cached = plain.with_lookup_cache()
+    for d in [cached, plain, cached]:
+        assert d[('a', 'b')] == 'x'
+        assert ('a', 'b') in d and ('b', 'a') not in d
+        with pytest.raises(KeyError):
+            d[('b', 'a')]
+    assert (cached.query([('b', 'c'), ('a', 'b')]) ==
+            cached.query([('a', 'b'), ('b', 'c')]) == fsa('x', 'y'))
+    assert cached.lookup_cache_info().hits > 0
+
+@given(escapedtext(), lists(escapedtext(), min_size=1, unique=True),
+       integers(1, 5))
+def test_weighted_query_returns_n_best_values(key, values, n):
+    triples = [(key, v, i) for i, v in enumerate(values)]
+    t = wfst(triples)
+    assert t.query(key, n=n) == [(v, float(i)) for i, v in
+                                 enumerate(values[:n])]
+    assert t[key] == values[0]
+
+def test_weighted_query_counts_each_value_once():
+    # 'ab' maps to 'x' along two paths, aligned differently.
+    t = ((wfst([('a', 'x', 1)]) + wfst([('b', '', 0)])) |
+         (wfst([('a', '', 0.5)]) + wfst([('b', 'x', 0)])) |
+         wfst([('ab', 'y', 2)]))
+    assert t.query('ab', n=2) == [('x', 0.5), ('y', 2.0)]
+
+def test_cached_build_skips_rebuilding(tmpdir):
+    calls = []
+    @cached_build("test", cache_dir=str(tmpdir))
+    def build(n):
+        calls.append(n)
+        return fst({str(n): "x"}).star()
+    first = build(1)
+    assert build(1) == first
+    assert calls == [1]
+    build(2)
+    assert calls == [1, 2]
+
+def test_cached_build_rebuilds_stale_entries(tmpdir):
+    calls = []
+    @cached_build("test", cache_dir=str(tmpdir))
+    def build(letters):
+        calls.append(letters)
+        return fsa(letters)
+    assert build({'a', 'b', 'c'}) == build(set('cba')) == fsa('a', 'b', 'c')
+    assert len(calls) == 1
+    # An entry pickled by code that has since moved.
+    for entry in tmpdir.listdir(lambda path: path.ext == ".pickle"):
+        entry.write_binary(b"cno_such_module\nContainer\n.")
+    assert build({'a', 'b', 'c'}) == fsa('a', 'b', 'c')
+    assert len(calls) == 2
+    with pytest.raises(TypeError):
+        build(object())
+
+def _doubler(s):
+    return fst({s: s + s})
+
+def test_compile_parallel_matches_union():
+    keys = ["a", "b", "ab", "ba", "abc"]
+    expected = fst().union(_doubler(k) for k in keys)
+    assert compile_parallel(_doubler, keys, workers=2) == expected
+    assert compile_parallel(_doubler, keys, workers=2, combine=False) == [
+        _doubler(k) for k in keys]
+
+@given(lists(dictionaries(text(alphabet="abc", min_size=1),
+                          text(alphabet="xyz", min_size=1), max_size=4),
+             min_size=1, max_size=4))
+def test_priority_union_behaves_like_chainmap(ds):
+    chained = collections.ChainMap(*ds)
+    result = fst(ds[0]).priority_union(*ds[1:])
+    assert sorted(result.items()) == sorted(chained.items())
+    folded = fst(ds[0])
+    for d in ds[1:]:
+        folded = folded >> d
+    assert result == folded
+
+@given(dictionaries(text(alphabet="abc", min_size=1),
+                    text(alphabet="xyz", min_size=1), min_size=1))
+def test_sampled_items_are_items(d):
+    samples = fst(d).sample_items(20, seed=0)
+    assert len(samples) == 20
+    assert set(samples) <= set(d.items())
+
+@given(text(alphabet="abc"), lists(integers(min_value=0, max_value=20),
+                                   max_size=3))
+def test_streamed_rewrite_matches_whole_text_rewrite(t, cuts):
+    rule = fst({'a': 'b'}).between(left='c', right='c')
+    cuts = sorted(min(cut, len(t)) for cut in cuts)
+    chunks = [t[i:j] for i, j in zip([0] + cuts, cuts + [len(t)])]
+    assert ''.join(rule.rewrite_text(chunks)) == rule[t]
+
+@given(escapedtext(), lists(integers(min_value=0, max_value=20), max_size=3))
+def test_streamed_output_is_spelled_like_the_tokens_it_holds(t, cuts):
+    outputs = {'a': ['\\'], 'b': ['[', '\\'], '[': ['\\', ']'], ']': [],
+               '\\': ['[xy]', '\\'], '[xy]': ['a', '\\']}
+    rule = fst({graph.detokenize([k]): graph.detokenize(v)
+                for k, v in outputs.items()}).star()
+    cuts = sorted(min(cut, len(t)) for cut in cuts)
+    chunks = [t[i:j] for i, j in zip([0] + cuts, cuts + [len(t)])]
+    expected = graph.detokenize([label for token in graph.tokenize(t)
+                                 for label in outputs[token]])
+    assert ''.join(rule.rewrite_text(chunks)) == expected
+
+@given(text(alphabet="abcd"))
+def test_rule_set_cascade_matches_rules_applied_in_turn(t):
+    rules = [({'a': 'b'}, 'c', ''), ({'b': 'd'}, '', 'd')]
+    ruleSet = RuleSet(rules, workers=1)
+    assert ruleSet.cascade()[t] == ruleSet.apply(t)
+    assert ''.join(ruleSet.rewrite_text([t[:2], t[2:]])) == ruleSet.apply(t)
+    assert all(stats.cached for stats in RuleSet(rules, workers=1).stats)